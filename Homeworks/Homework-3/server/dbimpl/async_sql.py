@@ -0,0 +1,70 @@
+from __future__ import annotations
+import asyncio
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Dict, List, Optional, Tuple
+from sqlalchemy import event
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
+
+# Async twin of the request path in sql.py, on the same tables and the same
+# statements. Schema setup and the background jobs stay on the sync engine.
+from .sql import (Message, _ShortTermWriteThrough, _add_missing_user_and_session, _as_chat, _build_url,
+                  _count_messages_stmt, _count_query, _enqueue_job_stmt, _latest_summaries_stmt,
+                  _recent_messages_stmt, _user_and_session_exist_stmt)
+
+engine = create_async_engine(_build_url(async_=True), echo=False)
+# count_queries() in sql.py sees these statements too
+event.listen(engine.sync_engine, "before_cursor_execute", _count_query)
+
+class AsyncUnitOfWork(_ShortTermWriteThrough):
+    """UnitOfWork on an AsyncSession; same methods, awaited. One session
+    can't run two statements at once, so gather across units of work, not
+    within one."""
+
+    def __init__(self):
+        self.s = AsyncSession(engine, expire_on_commit=False)
+        self._short_term: Dict[str, List[dict]] = {}
+
+    async def commit(self):
+        await self.s.commit()
+        # redis-py is blocking; keep it off the event loop
+        await asyncio.to_thread(self._push_short_term)
+
+    async def flush(self):
+        await self.s.flush()
+
+    async def ensure_user_and_session(self, user_key: str, session_key: str):
+        has_user, has_session = (await self.s.execute(_user_and_session_exist_stmt(user_key, session_key))).one()
+        _add_missing_user_and_session(self.s, user_key, session_key, has_user, has_session)
+
+    def save_message(self, user_key: str, session_key: str, role: str, content: str) -> Message:
+        m = Message(user_key=user_key, session_key=session_key, role=role, content=content)
+        self.s.add(m)
+        self._queue_short_term(session_key, role, content)
+        return m
+
+    async def fetch_recent_messages(self, session_key: str, limit: int = 20):
+        return _as_chat((await self.s.scalars(_recent_messages_stmt(session_key, limit))).all())
+
+    async def count_user_messages(self, session_key: str, role: Optional[str] = "user"):
+        return (await self.s.execute(_count_messages_stmt(session_key, role))).scalar_one()
+
+    async def latest_summaries(self, user_key: str, session_key: str) -> Tuple[Optional[str], Optional[str]]:
+        """(session summary, user lifetime summary) in one query."""
+        rows = {r.scope: r.text for r in await self.s.scalars(_latest_summaries_stmt(user_key, session_key))}
+        return rows.get("session"), rows.get("user")
+
+    async def enqueue_job(self, kind: str, payload: dict, idem_key: str):
+        await self.s.execute(_enqueue_job_stmt(engine.dialect.name, kind, payload, idem_key))
+
+@asynccontextmanager
+async def unit_of_work() -> AsyncIterator[AsyncUnitOfWork]:
+    uow = AsyncUnitOfWork()
+    try:
+        yield uow
+        await uow.commit()
+    except Exception:
+        await uow.s.rollback()
+        uow._short_term.clear()
+        raise
+    finally:
+        await uow.s.close()
@@ -1,27 +1,52 @@
 from __future__ import annotations
-import os, json, datetime as dt
-from typing import List, Optional, Tuple
-from sqlalchemy import create_engine, Integer, String, DateTime, Text, JSON, ForeignKey
+import os, json, time, datetime as dt
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Dict, Iterator, List, Optional, Tuple
+import numpy as np
+from sqlalchemy import create_engine, event, exists, inspect, select, text, update, and_, or_, Integer, String, DateTime, Text, JSON, ForeignKey, LargeBinary, Float
+from sqlalchemy.dialects import postgresql, sqlite
 from sqlalchemy.orm import DeclarativeBase, Mapped, mapped_column, relationship, Session
 from sqlalchemy.sql import func
+from ..services.redis_cache import append_short_term
 
 DB_BACKEND = os.getenv("DB_BACKEND", "sqlite")
 SQLITE_PATH = os.getenv("SQLITE_PATH", "/data/memory.db")
 
-def _build_url():
+def _build_url(async_: bool = False):
     if DB_BACKEND == "postgres":
         host = os.getenv("POSTGRES_HOST", "postgres")
         port = os.getenv("POSTGRES_PORT", "5432")
         db = os.getenv("POSTGRES_DB", "memorydb")
         user = os.getenv("POSTGRES_USER", "memory")
         pw = os.getenv("POSTGRES_PASSWORD", "memorypw")
-        return f"postgresql+psycopg2://{user}:{pw}@{host}:{port}/{db}"
+        driver = "asyncpg" if async_ else "psycopg2"
+        return f"postgresql+{driver}://{user}:{pw}@{host}:{port}/{db}"
     # default sqlite
     os.makedirs(os.path.dirname(SQLITE_PATH), exist_ok=True)
-    return f"sqlite:///{SQLITE_PATH}"
+    return f"sqlite+aiosqlite:///{SQLITE_PATH}" if async_ else f"sqlite:///{SQLITE_PATH}"
 
 engine = create_engine(_build_url(), echo=False, future=True)
 
+# per-request statement counter, see count_queries()
+_query_count: ContextVar[Optional[list]] = ContextVar("_query_count", default=None)
+
+@event.listens_for(engine, "before_cursor_execute")
+def _count_query(*_):
+    c = _query_count.get()
+    if c is not None:
+        c[0] += 1
+
+@contextmanager
+def count_queries() -> Iterator[list]:
+    """Counts statements sent to the DB inside the block; read counter[0]."""
+    counter = [0]
+    token = _query_count.set(counter)
+    try:
+        yield counter
+    finally:
+        _query_count.reset(token)
+
 class Base(DeclarativeBase): pass
 
 class User(Base):
@@ -62,37 +87,165 @@ class Episode(Base):
     session_key: Mapped[Optional[str]] = mapped_column(String(128), nullable=True)
     fact: Mapped[str] = mapped_column(Text)
     importance: Mapped[float] = mapped_column()  # 0..1
-    embedding: Mapped[Optional[str]] = mapped_column(Text, nullable=True)  # JSON list of floats
+    embedding: Mapped[Optional[str]] = mapped_column(Text, nullable=True)  # legacy: JSON list of floats
+    embedding_f32: Mapped[Optional[bytes]] = mapped_column(LargeBinary, nullable=True)  # raw float32
+    created_at: Mapped[dt.datetime] = mapped_column(DateTime(timezone=True), server_default=func.now())
+
+class Job(Base):
+    # durable background work; idem_key makes enqueueing the same work twice a no-op
+    __tablename__ = "jobs"
+    id: Mapped[int] = mapped_column(Integer, primary_key=True, autoincrement=True)
+    kind: Mapped[str] = mapped_column(String(64))
+    payload: Mapped[str] = mapped_column(Text)  # JSON
+    idem_key: Mapped[str] = mapped_column(String(256), unique=True)
+    status: Mapped[str] = mapped_column(String(16), default="pending", index=True)  # pending/running/done/failed
+    attempts: Mapped[int] = mapped_column(Integer, default=0)
+    run_after: Mapped[float] = mapped_column(Float, default=0.0)
+    last_error: Mapped[Optional[str]] = mapped_column(Text, nullable=True)
     created_at: Mapped[dt.datetime] = mapped_column(DateTime(timezone=True), server_default=func.now())
 
 def init_db():
     Base.metadata.create_all(engine)
+    # databases created before embedding_f32 existed
+    cols = {c["name"] for c in inspect(engine).get_columns("episodes")}
+    if "embedding_f32" not in cols:
+        blob = LargeBinary().compile(dialect=engine.dialect)
+        with engine.begin() as conn:
+            conn.execute(text(f"ALTER TABLE episodes ADD COLUMN embedding_f32 {blob}"))
 
 def get_session() -> Session:
     return Session(engine)
 
+# Statements shared by UnitOfWork and AsyncUnitOfWork (async_sql.py); each is
+# built here once and executed by whichever session the caller has
+def _user_and_session_exist_stmt(user_key: str, session_key: str):
+    return select(exists().where(User.user_key==user_key),
+                  exists().where(SessionRec.session_key==session_key))
+
+def _add_missing_user_and_session(s, user_key: str, session_key: str, has_user: bool, has_session: bool):
+    if not has_user:
+        s.add(User(user_key=user_key))
+    if not has_session:
+        s.add(SessionRec(session_key=session_key, user_key=user_key))
+
+def _recent_messages_stmt(session_key: str, limit: int):
+    return select(Message).where(Message.session_key==session_key).order_by(Message.id.desc()).limit(limit)
+
+def _as_chat(rows) -> List[dict]:
+    # newest-first rows to oldest-first chat messages
+    return [{"role": r.role, "content": r.content} for r in reversed(rows)]
+
+def _count_messages_stmt(session_key: str, role: Optional[str]):
+    q = select(func.count()).select_from(Message).where(Message.session_key==session_key)
+    return q.where(Message.role==role) if role else q
+
+def _latest_summaries_stmt(user_key: str, session_key: str):
+    newest = select(func.max(Summary.id)).where(
+        Summary.user_key==user_key,
+        or_(Summary.scope=="user", and_(Summary.scope=="session", Summary.session_key==session_key)),
+    ).group_by(Summary.scope)
+    return select(Summary).where(Summary.id.in_(newest))
+
+def _enqueue_job_stmt(dialect_name: str, kind: str, payload: dict, idem_key: str):
+    dialect = postgresql if dialect_name == "postgresql" else sqlite
+    stmt = dialect.insert(Job).values(kind=kind, payload=json.dumps(payload), idem_key=idem_key,
+                                      status="pending", attempts=0, run_after=0.0)
+    return stmt.on_conflict_do_nothing(index_elements=["idem_key"])
+
+class _ShortTermWriteThrough:
+    # saved messages are appended to the Redis short-term list once committed
+    def _queue_short_term(self, session_key: str, role: str, content: str):
+        self._short_term.setdefault(session_key, []).append({"role": role, "content": content})
+
+    def _push_short_term(self):
+        pending, self._short_term = self._short_term, {}
+        for session_key, messages in pending.items():
+            append_short_term(session_key, messages)
+
+class UnitOfWork(_ShortTermWriteThrough):
+    """One Session for a whole request. Adds are flushed by the next query and
+    written by commit(); call commit() before slow work (LLM calls) so no
+    transaction is held open across it. See unit_of_work()."""
+
+    def __init__(self):
+        self.s = get_session()
+        self._short_term: Dict[str, List[dict]] = {}
+
+    def commit(self):
+        self.s.commit()
+        self._push_short_term()
+
+    def ensure_user_and_session(self, user_key: str, session_key: str):
+        has_user, has_session = self.s.execute(_user_and_session_exist_stmt(user_key, session_key)).one()
+        _add_missing_user_and_session(self.s, user_key, session_key, has_user, has_session)
+
+    def flush(self):
+        self.s.flush()
+
+    def save_message(self, user_key: str, session_key: str, role: str, content: str) -> Message:
+        m = Message(user_key=user_key, session_key=session_key, role=role, content=content)
+        self.s.add(m)
+        self._queue_short_term(session_key, role, content)
+        return m
+
+    def fetch_recent_messages(self, session_key: str, limit: int = 20):
+        return _as_chat(self.s.scalars(_recent_messages_stmt(session_key, limit)).all())
+
+    def count_user_messages(self, session_key: str, role: Optional[str] = "user"):
+        return self.s.execute(_count_messages_stmt(session_key, role)).scalar_one()
+
+    def latest_summaries(self, user_key: str, session_key: str) -> Tuple[Optional[str], Optional[str]]:
+        """(session summary, user lifetime summary) in one query."""
+        rows = {r.scope: r.text for r in self.s.scalars(_latest_summaries_stmt(user_key, session_key))}
+        return rows.get("session"), rows.get("user")
+
+    def save_summary(self, user_key: str, session_key: str, scope: str, text: str):
+        self.s.add(Summary(user_key=user_key, session_key=session_key, scope=scope, text=text))
+
+    def save_episode(self, user_key: str, session_key: Optional[str], fact: str, importance: float, embedding: Optional[list]):
+        blob = np.asarray(embedding, dtype=np.float32).tobytes() if embedding is not None and len(embedding) else None
+        self.s.add(Episode(user_key=user_key, session_key=session_key, fact=fact, importance=importance, embedding_f32=blob))
+
+    def enqueue_job(self, kind: str, payload: dict, idem_key: str):
+        # part of the request's transaction, so the job exists iff the message does
+        self.s.execute(_enqueue_job_stmt(engine.dialect.name, kind, payload, idem_key))
+
+    def finish_job(self, job_id: int, attempts: int):
+        # commits with the handler's writes; (id, attempts) is the claim, so a
+        # worker whose lease ran out and was re-claimed rolls back instead
+        done = self.s.execute(update(Job).where(Job.id==job_id, Job.status=="running", Job.attempts==attempts)
+                              .values(status="done", last_error=None)).rowcount
+        if not done:
+            raise LookupError(f"job {job_id} attempt {attempts} lost its lease")
+
+@contextmanager
+def unit_of_work() -> Iterator[UnitOfWork]:
+    uow = UnitOfWork()
+    try:
+        yield uow
+        uow.commit()
+    except Exception:
+        uow.s.rollback()
+        uow._short_term.clear()
+        raise
+    finally:
+        uow.s.close()
+
 def save_message(user_key: str, session_key: str, role: str, content: str):
-    with get_session() as s:
-        s.add(Message(user_key=user_key, session_key=session_key, role=role, content=content))
-        s.commit()
+    with unit_of_work() as uow:
+        uow.save_message(user_key, session_key, role, content)
 
 def fetch_recent_messages(session_key: str, limit: int = 20):
-    with get_session() as s:
-        rows = s.query(Message).filter(Message.session_key==session_key).order_by(Message.id.desc()).limit(limit).all()
-        rows = list(reversed(rows))
-        return [{"role": r.role, "content": r.content} for r in rows]
+    with unit_of_work() as uow:
+        return uow.fetch_recent_messages(session_key, limit)
 
 def count_user_messages(session_key: str, role: Optional[str] = "user"):
-    with get_session() as s:
-        q = s.query(Message).filter(Message.session_key==session_key)
-        if role:
-            q = q.filter(Message.role==role)
-        return q.count()
+    with unit_of_work() as uow:
+        return uow.count_user_messages(session_key, role)
 
 def save_summary(user_key: str, session_key: str, scope: str, text: str):
-    with get_session() as s:
-        s.add(Summary(user_key=user_key, session_key=session_key, scope=scope, text=text))
-        s.commit()
+    with unit_of_work() as uow:
+        uow.save_summary(user_key, session_key, scope, text)
 
 def latest_summary(user_key: str, session_key: Optional[str], scope: str) -> Optional[str]:
     with get_session() as s:
@@ -103,19 +256,29 @@ def latest_summary(user_key: str, session_key: Optional[str], scope: str) -> Opt
         return row.text if row else None
 
 def save_episode(user_key: str, session_key: Optional[str], fact: str, importance: float, embedding: Optional[list]):
-    with get_session() as s:
-        s.add(Episode(user_key=user_key, session_key=session_key, fact=fact, importance=importance, embedding=json.dumps(embedding) if embedding else None))
-        s.commit()
+    with unit_of_work() as uow:
+        uow.save_episode(user_key, session_key, fact, importance, embedding)
+def _episode_embedding(e: Episode) -> Optional[np.ndarray]:
+    if e.embedding_f32:
+        return np.frombuffer(e.embedding_f32, dtype=np.float32)
+    if e.embedding:
+        return np.asarray(json.loads(e.embedding), dtype=np.float32)
+    return None
 
 def fetch_all_episodes(user_key: str):
     with get_session() as s:
         eps = s.query(Episode).filter(Episode.user_key==user_key).order_by(Episode.id.desc()).all()
         out = []
         for e in eps:
-            emb = json.loads(e.embedding) if e.embedding else None
-            out.append({"fact": e.fact, "importance": e.importance, "embedding": emb, "created_at": e.created_at.isoformat()})
+            out.append({"id": e.id, "fact": e.fact, "importance": e.importance, "embedding": _episode_embedding(e), "created_at": e.created_at.isoformat()})
         return out
 
+def fetch_episodes_since(user_key: str, after_id: int = 0):
+    # oldest first, so callers can keep a high-water mark and append
+    with get_session() as s:
+        eps = s.query(Episode).filter(Episode.user_key==user_key, Episode.id > after_id).order_by(Episode.id).all()
+        return [{"id": e.id, "fact": e.fact, "importance": e.importance, "embedding": _episode_embedding(e)} for e in eps]
+
 def aggregate_counts_by_day(user_key: str):
     with get_session() as s:
         rows = s.query(Message).filter(Message.user_key==user_key).all()
@@ -126,11 +289,40 @@ def aggregate_counts_by_day(user_key: str):
         return by_day
 
 def ensure_user_and_session(user_key: str, session_key: str):
+    with unit_of_work() as uow:
+        uow.ensure_user_and_session(user_key, session_key)
+
+def claim_job(lease: float = 300.0) -> Optional[dict]:
+    """Marks the oldest runnable job running and returns it, or None. The
+    conditional UPDATE makes the claim safe across worker threads/processes;
+    while running, run_after holds the lease deadline."""
+    with get_session() as s:
+        now = time.time()
+        rows = s.execute(select(Job.id, Job.kind, Job.payload, Job.attempts)
+                         .where(Job.status=="pending", Job.run_after <= now).order_by(Job.id).limit(5)).all()
+        for job_id, kind, payload, attempts in rows:
+            # matching attempts too stops a stale read from re-claiming a job retried since
+            claimed = s.execute(update(Job).where(Job.id==job_id, Job.status=="pending", Job.attempts==attempts)
+                                .values(status="running", attempts=attempts + 1, run_after=now + lease)).rowcount
+            s.commit()
+            if claimed:
+                return {"id": job_id, "kind": kind, "payload": json.loads(payload), "attempts": attempts + 1}
+        return None
+
+def fail_job(job_id: int, attempts: int, error: str, retry_in: Optional[float]):
+    # retry_in=None gives up on the job; a no-op if this attempt no longer holds it
+    with get_session() as s:
+        values = {"status": "failed", "last_error": error[:2000]}
+        if retry_in is not None:
+            values.update(status="pending", run_after=time.time() + retry_in)
+        s.execute(update(Job).where(Job.id==job_id, Job.status=="running", Job.attempts==attempts)
+                  .values(**values))
+        s.commit()
+
+def requeue_expired_jobs() -> int:
+    # running jobs whose lease ran out belong to a worker that died
     with get_session() as s:
-        u = s.query(User).filter(User.user_key==user_key).first()
-        if not u:
-            s.add(User(user_key=user_key))
-        sess = s.query(SessionRec).filter(SessionRec.session_key==session_key).first()
-        if not sess:
-            s.add(SessionRec(session_key=session_key, user_key=user_key))
+        n = s.execute(update(Job).where(Job.status=="running", Job.run_after < time.time())
+                      .values(status="pending", run_after=0.0)).rowcount
         s.commit()
+        return n
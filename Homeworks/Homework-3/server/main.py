@@ -6,6 +6,7 @@ from dotenv import load_dotenv
 
 from .routers import chat, introspect
 from .dbimpl import sql as db
+from .services.task_queue import worker
 
 load_dotenv(".env")
 
@@ -14,6 +15,15 @@ app = FastAPI(title="OpenAI Memory Demo")
 # Init DB
 db.init_db()
 
+# Background jobs (episode extraction, summaries)
+@app.on_event("startup")
+def start_worker():
+    worker.start()
+
+@app.on_event("shutdown")
+def stop_worker():
+    worker.stop()
+
 # Routers
 app.include_router(chat.router, prefix="/api", tags=["chat"])
 app.include_router(introspect.router, prefix="/api", tags=["introspect"])
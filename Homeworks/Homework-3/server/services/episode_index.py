@@ -0,0 +1,117 @@
+"""Per-user in-memory index over episodic memory embeddings.
+
+Each user's episodes are kept as one L2-normalized float32 matrix, so ranking
+is a single matrix-vector product plus argpartition instead of a Python loop
+over JSON-decoded rows. The matrix is synced incrementally: every lookup asks
+the DB only for episodes newer than the last id it has seen. Users with more
+than EPISODE_ANN_MIN episodes are also indexed with an HNSW graph when faiss
+is installed.
+"""
+import os, threading
+from collections import OrderedDict
+from typing import List, Optional
+
+import numpy as np
+
+from ..dbimpl import sql as db
+
+ANN_MIN_EPISODES = int(os.getenv("EPISODE_ANN_MIN", "20000"))
+MAX_USERS = int(os.getenv("EPISODE_INDEX_USERS", "256"))
+
+try:
+    import faiss
+except ImportError:
+    faiss = None
+
+
+def _normalize(m: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(m, axis=-1, keepdims=True)
+    return m / np.where(norms == 0, 1, norms)
+
+
+class _UserEpisodes:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.last_id = 0
+        self.facts: List[str] = []
+        self.emb: Optional[np.ndarray] = None  # capacity-doubled buffer; first n rows live
+        self.n = 0
+        self.ann = None
+
+    def append(self, facts: List[str], vecs: np.ndarray):
+        if not facts:
+            return
+        if self.emb is None or self.n + len(vecs) > len(self.emb):
+            cap = max(64, 2 * (self.n + len(vecs)))
+            emb = np.empty((cap, vecs.shape[1]), dtype=np.float32)
+            if self.emb is not None:
+                emb[:self.n] = self.emb[:self.n]
+            self.emb = emb
+        self.emb[self.n:self.n + len(vecs)] = vecs
+        self.n += len(vecs)
+        self.facts.extend(facts)
+        if self.ann is not None:
+            self.ann.add(vecs)
+        elif faiss is not None and self.n >= ANN_MIN_EPISODES:
+            self.ann = faiss.IndexHNSWFlat(vecs.shape[1], 32, faiss.METRIC_INNER_PRODUCT)
+            self.ann.add(self.emb[:self.n])
+
+    def search(self, q: np.ndarray, k: int) -> List[str]:
+        k = min(k, self.n)
+        if self.ann is not None:
+            _, idx = self.ann.search(q[None, :], k)
+            return [self.facts[i] for i in idx[0] if i >= 0]
+        sims = self.emb[:self.n] @ q
+        top = np.argpartition(-sims, k - 1)[:k]
+        top = top[np.argsort(-sims[top])]
+        return [self.facts[i] for i in top]
+
+
+class EpisodeIndex:
+    def __init__(self, max_users: int = MAX_USERS):
+        self.max_users = max_users
+        self._users: "OrderedDict[str, _UserEpisodes]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _user(self, user_key: str) -> _UserEpisodes:
+        with self._lock:
+            u = self._users.get(user_key)
+            if u is None:
+                u = self._users[user_key] = _UserEpisodes()
+            self._users.move_to_end(user_key)
+            while len(self._users) > self.max_users:
+                self._users.popitem(last=False)
+            return u
+
+    def _sync(self, user_key: str, u: _UserEpisodes):
+        rows = db.fetch_episodes_since(user_key, u.last_id)
+        if not rows:
+            return
+        u.last_id = rows[-1]["id"]
+        rows = [r for r in rows if r["embedding"] is not None and len(r["embedding"])]
+        if not rows:
+            return
+        # rows from an earlier embedding model have another width and can't be scored
+        width = u.emb.shape[1] if u.emb is not None else len(rows[-1]["embedding"])
+        rows = [r for r in rows if len(r["embedding"]) == width]
+        if rows:
+            u.append([r["fact"] for r in rows], _normalize(np.stack([r["embedding"] for r in rows])))
+
+    def sync(self, user_key: str) -> int:
+        """Pulls the user's new episodes from the DB; returns how many are indexed."""
+        u = self._user(user_key)
+        with u.lock:
+            self._sync(user_key, u)
+            return u.n
+
+    def search(self, user_key: str, query_vec, k: int = 5) -> List[str]:
+        """Ranks the already-synced episodes against an embedded query."""
+        u = self._user(user_key)
+        q = _normalize(np.asarray(query_vec, dtype=np.float32))
+        with u.lock:
+            if not u.n or q.shape[0] != u.emb.shape[1]:
+                return []
+            return u.search(q, k)
+
+
+episode_index = EpisodeIndex()
@@ -1,9 +1,12 @@
 from typing import List, Tuple, Dict
-import os, json
-from .openai_client import get_client, response_model
-from .embeddings import embed_texts, top_k_by_embedding
+import asyncio, os, json
+from .openai_client import get_async_client, get_client, response_model
+from .embeddings import aembed_texts, embed_texts
+from .episode_index import episode_index
 from ..dbimpl import sql as db
-from .redis_cache import get_short_term, set_short_term
+from ..dbimpl import async_sql as adb
+from .redis_cache import SHORT_TERM_CAP, get_short_term, warm_short_term
+from .task_queue import job, worker
 
 SHORT_TERM_N = 8
 SUMMARIZE_EVERY_USER_MSGS =3
@@ -13,26 +16,26 @@ SYSTEM_PRIMER = (
     "Keep answers concise and friendly. If the user asks about what the app remembers, explain short-term, long-term, and episodic memory briefly."
 )
 
-def _build_context(user_key: str, session_key: str) -> Tuple[List[Dict,], str, List[str]]:
-    # short-term from redis or DB
-    st = get_short_term(session_key)
+async def _build_context(uow: adb.AsyncUnitOfWork, user_key: str, session_key: str) -> Tuple[List[Dict,], str]:
+    # short-term from redis (sync client, so off the loop); when it's cold, one DB
+    # query back-fills the list
+    st = await asyncio.to_thread(get_short_term, session_key, SHORT_TERM_N)
     if not st:
-        st = db.fetch_recent_messages(session_key, limit=SHORT_TERM_N * 2)
+        st = await uow.fetch_recent_messages(session_key, limit=SHORT_TERM_CAP)
+        await asyncio.to_thread(warm_short_term, session_key, st)
     st = st[-SHORT_TERM_N:]
-    # long-term summaries
-    lt_session = db.latest_summary(user_key, session_key, scope="session")
-    lt_user = db.latest_summary(user_key, None, scope="user")
+    # long-term summaries, both in one query
+    lt_session, lt_user = await uow.latest_summaries(user_key, session_key)
     long_term_text = ""
     if lt_user:
         long_term_text += f"User lifetime summary:\n{lt_user}\n\n"
     if lt_session:
         long_term_text += f"This session summary:\n{lt_session}\n\n"
-    # episodic
-    episodes = db.fetch_all_episodes(user_key)
-    epi_texts = [e["fact"] for e in episodes]
-    return st, long_term_text.strip(), epi_texts
+    # episodic memory is ranked separately by episode_index
+    return st, long_term_text.strip()
 
-def extract_and_store_episodes(user_key: str, session_key: str, user_text: str):
+@job("extract_episodes")
+def extract_and_store_episodes(uow: db.UnitOfWork, user_key: str, session_key: str, user_text: str):
     client = get_client()
     model = response_model()
     messages = [
@@ -64,20 +67,29 @@ def extract_and_store_episodes(user_key: str, session_key: str, user_text: str):
         facts = []
     if not facts:
         return
-    # embed and store
+    # embed and store; the episodes commit together with the job's done mark
     emb = embed_texts([f["fact"] for f in facts])
     for (f, e) in zip(facts, emb):
         importance = float(f.get("importance", 0.5))
-        db.save_episode(user_key, session_key, f["fact"], importance, e)
+        uow.save_episode(user_key, session_key, f["fact"], importance, e)
 
-def maybe_summarize(user_key: str, session_key: str):
-    # Summarize every N user turns
-    user_count = db.count_user_messages(session_key, role="user")
+async def maybe_summarize(uow: adb.AsyncUnitOfWork, user_key: str, session_key: str):
+    # Summarize every N user turns, in the background; the count makes the key unique per turn
+    user_count = await uow.count_user_messages(session_key, role="user")
     if user_count % SUMMARIZE_EVERY_USER_MSGS != 0:
         return
+    await uow.enqueue_job("summarize", {"user_key": user_key, "session_key": session_key},
+                    f"summarize:{session_key}:{user_count}")
+
+@job("summarize")
+def summarize_session(uow: db.UnitOfWork, user_key: str, session_key: str):
+    # both summaries commit with the job's done mark, so a retry never doubles one
+    recent = uow.fetch_recent_messages(session_key, limit=100)
+    _, lifetime_src = uow.latest_summaries(user_key, session_key)
+    # end the read transaction before the LLM calls
+    uow.commit()
     client = get_client()
     model = response_model()
-    recent = db.fetch_recent_messages(session_key, limit=100)
     messages = [
         {"role":"system","content":"Summarize the recent conversation in 5-7 bullet points. Capture goals, decisions, preferences, and next steps. Keep it concise but specific."},
         {"role":"user","content": "\n\n".join([f"{m['role']}: {m['content']}" for m in recent])}
@@ -86,9 +98,8 @@ def maybe_summarize(user_key: str, session_key: str):
     summary_text = (resp.choices[0].message.content or "").strip()
 
     if summary_text:
-        db.save_summary(user_key, session_key, scope="session", text=summary_text)
+        uow.save_summary(user_key, session_key, scope="session", text=summary_text)
         # Occasionally refresh the user lifetime summary using session summaries
-        lifetime_src = db.latest_summary(user_key, None, scope="user")
         combined = (lifetime_src + "\n\n" if lifetime_src else "") + summary_text
         prompt2 = [
             {"role":"system","content":"Condense the provided session summaries into a single, up-to-date lifetime profile. Keep under 200 words."},
@@ -97,47 +108,66 @@ def maybe_summarize(user_key: str, session_key: str):
         resp2 = client.chat.completions.create(model=model, messages=prompt2, temperature=0.2, max_tokens=300)
         lt = (resp2.choices[0].message.content or "").strip()
         if lt:
-            db.save_summary(user_key, session_key="", scope="user", text=lt)
-
-def generate_reply(user_key: str, session_key: str, user_message: str):
-    # Persist the user message
-    db.ensure_user_and_session(user_key, session_key)
-    db.save_message(user_key, session_key, "user", user_message)
-
-    # Episode extraction (best-effort, non-blocking semantics here but we run inline)
-    extract_and_store_episodes(user_key, session_key, user_message)
-
-    # Build memory context
-    st, long_term, episodic_texts = _build_context(user_key, session_key)
-
-    # Retrieve top episodic items relevant to this user message
-    # Retrieve top-k episodic items relevant to this user message
-    episodes_full = db.fetch_all_episodes(user_key)
-    episodic_hits = top_k_by_embedding(user_message, episodes_full, k=5)
-    episodic_use = [e["fact"] for e in episodic_hits]
-
-    system = SYSTEM_PRIMER + "\n\n" + (f"Long-term memory: {long_term}" if long_term else "")
-    messages = [{"role":"system","content":system}]
-    for m in st[-8:]:
-        messages.append({"role": m["role"], "content": m["content"]})
-    messages.append({"role":"user","content": user_message})
-    if episodic_use:
-        messages.append({"role":"system","content":"Relevant episodic facts: " + "; ".join(episodic_use)})
-
-    client = get_client()
-    model = response_model()
-    resp = client.chat.completions.create(model=model, messages=messages, temperature=0.6, max_tokens=500)
-    reply = (resp.choices[0].message.content or "").strip()
-
-
-    # Save assistant reply
-    db.save_message(user_key, session_key, "assistant", reply)
-
-    # Update short-term cache
-    st2 = (st + [{"role":"user","content":user_message},{"role":"assistant","content":reply}])[-8:]
-    set_short_term(session_key, st2, ttl_seconds=1800)
-
-    # Maybe summarize
-    maybe_summarize(user_key, session_key)
+            uow.save_summary(user_key, session_key="", scope="user", text=lt)
 
+async def _gather_or_cancel(*aws):
+    # gather, but a failure cancels and awaits the rest first, so nothing is still
+    # running on the session when the unit of work rolls it back and closes it
+    tasks = [asyncio.ensure_future(a) for a in aws]
+    try:
+        return await asyncio.gather(*tasks)
+    except BaseException:
+        for t in tasks:
+            t.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        raise
+
+async def generate_reply(user_key: str, session_key: str, user_message: str):
+    async with adb.unit_of_work() as uow:
+        async def persist_and_load():
+            # Load context (history before this message), then persist the message,
+            # in one short transaction; commit appends it to the short-term list
+            await uow.ensure_user_and_session(user_key, session_key)
+            context = await _build_context(uow, user_key, session_key)
+            msg = uow.save_message(user_key, session_key, "user", user_message)
+            # Episode extraction runs in the background, committed with the message
+            await uow.flush()
+            await uow.enqueue_job("extract_episodes",
+                                  {"user_key": user_key, "session_key": session_key, "user_text": user_message},
+                                  f"extract:{msg.id}")
+            await uow.commit()
+            return context
+
+        # the DB round-trips, the query embedding and the episode index sync are independent
+        (st, long_term), query_vecs, n_episodes = await _gather_or_cancel(
+            persist_and_load(),
+            aembed_texts([user_message]),
+            asyncio.to_thread(episode_index.sync, user_key))
+        worker.notify()
+
+        # Retrieve top-k episodic items relevant to this user message
+        episodic_use = episode_index.search(user_key, query_vecs[0], k=5) if n_episodes and query_vecs else []
+
+        system = SYSTEM_PRIMER + "\n\n" + (f"Long-term memory: {long_term}" if long_term else "")
+        messages = [{"role":"system","content":system}]
+        for m in st[-8:]:
+            messages.append({"role": m["role"], "content": m["content"]})
+        messages.append({"role":"user","content": user_message})
+        if episodic_use:
+            messages.append({"role":"system","content":"Relevant episodic facts: " + "; ".join(episodic_use)})
+
+        resp = await get_async_client().chat.completions.create(
+            model=response_model(), messages=messages, temperature=0.6, max_tokens=500)
+        reply = (resp.choices[0].message.content or "").strip()
+
+        # Save assistant reply
+        uow.save_message(user_key, session_key, "assistant", reply)
+
+        # The short-term list gets the reply on commit (write-through)
+        st2 = (st + [{"role":"user","content":user_message},{"role":"assistant","content":reply}])[-8:]
+
+        # Maybe summarize
+        await maybe_summarize(uow, user_key, session_key)
+
+    worker.notify()
     return reply, st2, long_term, episodic_use
@@ -1,9 +1,23 @@
 import os
-from openai import OpenAI
+from typing import Optional
+from openai import AsyncOpenAI, OpenAI
+
+# one client per process: each holds an HTTP connection pool worth reusing
+_client: Optional[OpenAI] = None
+_async_client: Optional[AsyncOpenAI] = None
 
 def get_client() -> OpenAI:
     # OPENAI_API_KEY should be set in the environment
-    return OpenAI()
+    global _client
+    if _client is None:
+        _client = OpenAI()
+    return _client
+
+def get_async_client() -> AsyncOpenAI:
+    global _async_client
+    if _async_client is None:
+        _async_client = AsyncOpenAI()
+    return _async_client
 
 def response_model() -> str:
     return os.getenv("OPENAI_MODEL", "gpt-4o-mini")
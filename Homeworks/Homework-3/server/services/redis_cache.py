@@ -18,21 +18,51 @@ def _get_redis():
         _redis = False
         return None
 
-def set_short_term(session_key: str, messages: List[Dict[str, Any]], ttl_seconds: int = 1800):
+# Short-term memory is a capped Redis list per session, one JSON message per
+# element: a turn appends its messages instead of rewriting the whole window.
+SHORT_TERM_CAP = int(os.getenv("SHORT_TERM_CAP", "16"))
+SHORT_TERM_TTL = 1800
+
+def _st_key(session_key: str) -> str:
+    # not st:{session}, which older versions stored as one JSON string
+    return f"st:list:{session_key}"
+
+def append_short_term(session_key: str, messages: List[Dict[str, Any]], ttl_seconds: int = SHORT_TERM_TTL):
+    r = _get_redis()
+    if not r or not messages:
+        return False
+    key = _st_key(session_key)
+    pipe = r.pipeline(transaction=False)
+    pipe.rpush(key, *[json.dumps(m) for m in messages])
+    pipe.ltrim(key, -SHORT_TERM_CAP, -1)
+    pipe.expire(key, ttl_seconds)
+    try:
+        pipe.execute()
+        return True
+    except Exception:
+        return False
+
+def warm_short_term(session_key: str, messages: List[Dict[str, Any]], ttl_seconds: int = SHORT_TERM_TTL):
+    """Replaces the list with messages loaded from the DB (oldest first)."""
     r = _get_redis()
-    if not r: 
+    if not r or not messages:
+        return False
+    key = _st_key(session_key)
+    pipe = r.pipeline()
+    pipe.delete(key)
+    pipe.rpush(key, *[json.dumps(m) for m in messages[-SHORT_TERM_CAP:]])
+    pipe.expire(key, ttl_seconds)
+    try:
+        pipe.execute()
+        return True
+    except Exception:
         return False
-    r.setex(f"st:{session_key}", ttl_seconds, json.dumps(messages))
-    return True
 
-def get_short_term(session_key: str):
+def get_short_term(session_key: str, n: int = SHORT_TERM_CAP):
     r = _get_redis()
     if not r:
         return None
-    v = r.get(f"st:{session_key}")
-    if not v:
-        return None
     try:
-        return json.loads(v)
+        return [json.loads(v) for v in r.lrange(_st_key(session_key), -n, -1)] or None
     except Exception:
         return None
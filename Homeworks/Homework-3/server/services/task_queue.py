@@ -0,0 +1,87 @@
+"""Background jobs for work that doesn't need to block a chat reply.
+
+Jobs live in the `jobs` table (see dbimpl/sql.py), so they survive restarts
+and can be enqueued inside the request's own transaction. Worker threads claim
+them one at a time; a failing job is retried with exponential backoff up to
+JOB_MAX_ATTEMPTS, then left as `failed` with its last error.
+
+A handler writes through the UnitOfWork it is given, and the job is marked
+done in that same commit: a job whose results were committed is never run
+again, and one that died before committing left nothing behind.
+"""
+import os, threading, traceback
+from typing import Callable, Dict, List
+
+from ..dbimpl import sql as db
+
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", "2"))
+JOB_MAX_ATTEMPTS = int(os.getenv("JOB_MAX_ATTEMPTS", "5"))
+JOB_RETRY_BASE = float(os.getenv("JOB_RETRY_BASE", "2.0"))
+JOB_POLL_SECONDS = 1.0
+
+_handlers: Dict[str, Callable[..., None]] = {}
+
+def job(kind: str):
+    """Registers fn as the handler for `kind`; it is called with a UnitOfWork and
+    the payload as kwargs, and must not commit its writes itself."""
+    def register(fn):
+        _handlers[kind] = fn
+        return fn
+    return register
+
+class TaskWorker:
+    def __init__(self, workers: int = JOB_WORKERS):
+        self.workers = workers
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._threads: List[threading.Thread] = []
+
+    def notify(self):
+        # new work committed in this process; other processes find it by polling
+        self._wake.set()
+
+    def start(self):
+        if self._threads:
+            return
+        self._stop.clear()
+        for i in range(self.workers):
+            t = threading.Thread(target=self._run, name=f"job-worker-{i}", daemon=True)
+            t.start()
+            self._threads.append(t)
+
+    def stop(self, timeout: float = 10.0):
+        self._stop.set()
+        self._wake.set()
+        for t in self._threads:
+            t.join(timeout)
+        self._threads = []
+
+    def run_once(self) -> bool:
+        """Runs one job if any is due; returns whether it did."""
+        j = db.claim_job()
+        if j is None:
+            return False
+        handler = _handlers.get(j["kind"])
+        try:
+            if handler is None:
+                raise LookupError(f"no handler for job kind {j['kind']!r}")
+            with db.unit_of_work() as uow:
+                handler(uow, **j["payload"])
+                uow.finish_job(j["id"], j["attempts"])
+        except Exception:
+            retry_in = JOB_RETRY_BASE ** j["attempts"] if j["attempts"] < JOB_MAX_ATTEMPTS else None
+            db.fail_job(j["id"], j["attempts"], traceback.format_exc(), retry_in)
+        return True
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                db.requeue_expired_jobs()
+                while not self._stop.is_set() and self.run_once():
+                    pass
+            except Exception:
+                traceback.print_exc()
+            self._wake.wait(JOB_POLL_SECONDS)
+            self._wake.clear()
+
+worker = TaskWorker()
@@ -0,0 +1,156 @@
+"""Per-prompt-class similarity thresholds for the semantic caches.
+
+Prompts are bucketed (by prompt kind and length), and each bucket keeps a
+window of labelled samples: the similarity of a prompt to its nearest cached
+neighbour, and whether serving that neighbour's answer would have been right.
+The bucket's threshold is the lowest similarity at which the false-hit rate of
+the samples at or above it stays within `false_hit_budget`.
+
+Samples come online from near-misses (a miss whose neighbour scored within
+`floor` of the threshold is labelled by comparing the fresh answer to the
+neighbour's answer) and offline from `replay` / `replay_file`. Near-misses
+alone can only lower a threshold; with `shadow_rate` > 0 that share of hits is
+also answered live (a paid call each, run on a small pool via `shadow`) and
+labelled the same way, which is what shows false hits above it.
+"""
+import json
+import random
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Iterable, Optional
+
+import numpy as np
+
+
+def length_class(text: str) -> str:
+    n = len(text)
+    if n < 200:
+        return "short"
+    if n < 1000:
+        return "medium"
+    return "long"
+
+
+def prompt_bucket(kind: str, text: str) -> str:
+    return f"{kind or 'default'}:{length_class(text)}"
+
+
+class AdaptiveThreshold:
+    def __init__(self, default: float = 0.92, false_hit_budget: float = 0.05,
+                 floor: float = 0.80, window: int = 500, min_samples: int = 30,
+                 agree: float = 0.9, shadow_rate: float = 0.0, shadow_workers: int = 2,
+                 shadow_queue: int = 8):
+        self.default = default
+        self.false_hit_budget = false_hit_budget
+        self.floor = floor
+        self.window = window
+        self.min_samples = min_samples
+        self.agree = agree
+        self.shadow_rate = shadow_rate
+        self.shadow_workers = shadow_workers
+        self._shadow_slots = threading.BoundedSemaphore(shadow_queue)
+        self._shadow_pool: Optional[ThreadPoolExecutor] = None
+        self._samples: dict[str, deque] = {}
+        self._thresholds: dict[str, float] = {}
+        self._lookups: dict[str, list[int]] = {}
+        self._lock = threading.Lock()
+
+    def threshold(self, bucket: str) -> float:
+        return self._thresholds.get(bucket, self.default)
+
+    def wants_label(self, bucket: str, sim: float) -> bool:
+        """True for a miss close enough to the threshold to be worth labelling."""
+        return self.floor <= sim < self.threshold(bucket)
+
+    def wants_shadow(self) -> bool:
+        """True for the sampled share of hits that should also be answered live."""
+        return random.random() < self.shadow_rate
+
+    def shadow(self, fn: Callable, *args) -> bool:
+        """Runs fn(*args), the live re-check of a sampled hit, on the shadow pool.
+        The sample is dropped if shadow_queue checks are already pending."""
+        if not self._shadow_slots.acquire(blocking=False):
+            return False
+        with self._lock:
+            if self._shadow_pool is None:
+                self._shadow_pool = ThreadPoolExecutor(self.shadow_workers,
+                                                       thread_name_prefix="shadow-verify")
+        self._shadow_pool.submit(self._run_shadow, fn, args)
+        return True
+
+    def _run_shadow(self, fn: Callable, args: tuple):
+        try:
+            fn(*args)
+        except Exception as e:
+            print(f"Shadow verification failed: {e!r}")
+        finally:
+            self._shadow_slots.release()
+
+    def label(self, bucket: str, sim: float, served: str, live: str,
+              embed: Callable[[str], np.ndarray]):
+        """Records whether serving `served` was right for a prompt `sim` away from
+        its neighbour: its embedding must be within `agree` of the live answer's."""
+        a, b = (np.asarray(embed(t), dtype=np.float32) for t in (served, live))
+        norms = float(np.linalg.norm(a) * np.linalg.norm(b))
+        self.record(bucket, sim, float(a @ b) / norms >= self.agree if norms else False)
+
+    def observe_lookup(self, bucket: str, hit: bool):
+        with self._lock:
+            counts = self._lookups.setdefault(bucket, [0, 0])
+            counts[0] += 1
+            counts[1] += hit
+
+    def record(self, bucket: str, sim: float, correct: bool):
+        with self._lock:
+            samples = self._samples.setdefault(bucket, deque(maxlen=self.window))
+            samples.append((float(sim), bool(correct)))
+            self._calibrate(bucket)
+
+    def replay(self, records: Iterable[tuple[str, float, bool]]):
+        """Offline calibration from labelled (bucket, similarity, correct) triples."""
+        for bucket, sim, correct in records:
+            self.record(bucket, sim, correct)
+
+    def replay_file(self, path: str):
+        """JSONL with {"bucket": ..., "similarity": ..., "correct": ...} per line."""
+        with open(path) as f:
+            self.replay((r["bucket"], r["similarity"], r["correct"])
+                        for r in map(json.loads, f) if r)
+
+    def _calibrate(self, bucket: str):
+        samples = self._samples[bucket]
+        if len(samples) < self.min_samples:
+            return
+        best: Optional[float] = None
+        accepted = false = 0
+        ordered = sorted(samples, reverse=True)
+        for i, (sim, correct) in enumerate(ordered):
+            accepted += 1
+            false += not correct
+            # only cut between distinct similarity values
+            if i + 1 < len(ordered) and ordered[i + 1][0] == sim:
+                continue
+            if false / accepted <= self.false_hit_budget:
+                best = sim
+        if best is not None:
+            self._thresholds[bucket] = min(max(best, self.floor), 0.999)
+
+    def _report(self, bucket: str) -> dict:
+        t = self.threshold(bucket)
+        samples = self._samples.get(bucket, ())
+        accepted = [c for s, c in samples if s >= t]
+        lookups, hits = self._lookups.get(bucket, (0, 0))
+        return {"threshold": round(t, 4), "samples": len(samples),
+                # share of labelled near-duplicates the threshold lets through,
+                # and how many of those were wrong: hit rate at the false-hit budget
+                "hit_rate_at_budget": round(len(accepted) / len(samples), 3) if samples else None,
+                "false_hit_rate": round(1 - sum(accepted) / len(accepted), 3) if accepted else None,
+                "lookups": lookups, "hits": hits}
+
+    @property
+    def stats(self):
+        with self._lock:
+            buckets = set(self._samples) | set(self._lookups)
+            return {"default": self.default, "false_hit_budget": self.false_hit_budget,
+                    "buckets": {b: self._report(b) for b in sorted(buckets)}}
@@ -0,0 +1,248 @@
+"""Nearest-neighbour indexes for the semantic LLM caches.
+
+Both indexes hold L2-normalized float32 rows under integer labels, with an
+insert timestamp per row for TTL deletes, and score by inner product (cosine).
+`FlatIndex` is an exact scan. `IVFFlatIndex` clusters rows with spherical
+k-means and only scans the `nprobe` closest lists; raising `nprobe` trades
+latency for recall.
+"""
+import time
+from typing import Optional
+
+import numpy as np
+
+
+def normalize(v) -> np.ndarray:
+    v = np.asarray(v, dtype=np.float32)
+    n = np.linalg.norm(v)
+    return v / n if n else v
+
+
+class FlatIndex:
+    """Exact search: one matrix-vector product plus argmax/argpartition."""
+
+    def __init__(self):
+        # row i of _emb / _ts / _labels is one entry; only the first _n rows are live
+        self._emb: Optional[np.ndarray] = None
+        self._ts = np.empty(0, dtype=np.float64)
+        self._labels = np.empty(0, dtype=np.int64)
+        self._pos: dict[int, int] = {}
+        self._n = 0
+
+    def __len__(self):
+        return self._n
+
+    def __contains__(self, label: int):
+        return label in self._pos
+
+    def _grow(self, dim: int):
+        cap = max(16, 2 * len(self._ts))
+        emb = np.empty((cap, dim), dtype=np.float32)
+        ts = np.empty(cap, dtype=np.float64)
+        labels = np.empty(cap, dtype=np.int64)
+        if self._emb is not None:
+            emb[:self._n] = self._emb[:self._n]
+            ts[:self._n] = self._ts[:self._n]
+            labels[:self._n] = self._labels[:self._n]
+        self._emb, self._ts, self._labels = emb, ts, labels
+
+    def add(self, label: int, vec: np.ndarray, ts: Optional[float] = None):
+        if label in self._pos:
+            self.remove(label)
+        if self._emb is None or self._n == len(self._ts):
+            self._grow(len(vec))
+        i = self._n
+        self._emb[i] = vec
+        self._ts[i] = time.time() if ts is None else ts
+        self._labels[i] = label
+        self._pos[label] = i
+        self._n += 1
+
+    def remove(self, label: int) -> bool:
+        i = self._pos.pop(label, None)
+        if i is None:
+            return False
+        # swap-remove: move the last live row into slot i
+        last = self._n - 1
+        if i != last:
+            self._emb[i] = self._emb[last]
+            self._ts[i] = self._ts[last]
+            self._labels[i] = self._labels[last]
+            self._pos[int(self._labels[i])] = i
+        self._n = last
+        return True
+
+    def expire(self, cutoff: float) -> list[int]:
+        """Drops every row inserted before `cutoff`; returns their labels."""
+        if not self._n:
+            return []
+        dead = [int(self._labels[i]) for i in np.flatnonzero(self._ts[:self._n] < cutoff)]
+        for label in dead:
+            self.remove(label)
+        return dead
+
+    def oldest(self) -> Optional[tuple[int, float]]:
+        if not self._n:
+            return None
+        i = int(np.argmin(self._ts[:self._n]))
+        return int(self._labels[i]), float(self._ts[i])
+
+    def rows(self) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+        return self._labels[:self._n], self._emb[:self._n], self._ts[:self._n]
+
+    def search(self, q: np.ndarray, k: int = 1) -> tuple[np.ndarray, np.ndarray]:
+        """Returns (labels, similarities), best first."""
+        if not self._n:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)
+        sims = self._emb[:self._n] @ q
+        if k == 1:
+            top = np.array([int(np.argmax(sims))])
+        else:
+            k = min(k, self._n)
+            top = np.argpartition(-sims, k - 1)[:k]
+            top = top[np.argsort(-sims[top])]
+        return self._labels[top], sims[top]
+
+
+def _kmeans(x: np.ndarray, k: int, iters: int = 10, seed: int = 0) -> np.ndarray:
+    """Spherical k-means on normalized rows; returns normalized centroids."""
+    rng = np.random.default_rng(seed)
+    c = x[rng.choice(len(x), size=k, replace=False)].copy()
+    for _ in range(iters):
+        assign = np.argmax(x @ c.T, axis=1)
+        order = np.argsort(assign, kind="stable")
+        counts = np.bincount(assign, minlength=k)
+        bounds = np.concatenate(([0], np.cumsum(counts)))
+        sums = np.zeros_like(c)
+        for j in np.flatnonzero(counts):
+            sums[j] = x[order[bounds[j]:bounds[j + 1]]].sum(axis=0)
+        empty = counts == 0
+        if empty.any():
+            sums[empty] = x[rng.choice(len(x), size=int(empty.sum()), replace=False)]
+        norms = np.linalg.norm(sums, axis=1, keepdims=True)
+        c = sums / np.where(norms == 0, 1, norms)
+    return c.astype(np.float32)
+
+
+class IVFFlatIndex:
+    """Inverted-file index: each row lives in the FlatIndex of its nearest
+    centroid, and a search only scans the `nprobe` lists closest to the query.
+
+    Until `train_at` rows exist it is a single exact list. Centroids are
+    retrained whenever the index has grown `retrain_factor`x since the last
+    training, so lists stay balanced as the cache fills.
+    """
+
+    def __init__(self, nlist: int = 64, nprobe: int = 8, train_at: Optional[int] = None,
+                 retrain_factor: float = 4.0):
+        self.nlist = nlist
+        self.nprobe = nprobe
+        self.train_at = train_at or 8 * nlist
+        self.retrain_factor = retrain_factor
+        self._centroids: Optional[np.ndarray] = None
+        self._lists: list[FlatIndex] = [FlatIndex()]
+        self._where: dict[int, int] = {}
+        self._trained_n = 0
+
+    def __len__(self):
+        return len(self._where)
+
+    def __contains__(self, label: int):
+        return label in self._where
+
+    def _assign(self, vec: np.ndarray) -> int:
+        if self._centroids is None:
+            return 0
+        return int(np.argmax(self._centroids @ vec))
+
+    def train(self):
+        labels, emb, ts = [], [], []
+        for lst in self._lists:
+            lb, e, t = lst.rows()
+            labels.append(lb.copy()); emb.append(e.copy()); ts.append(t.copy())
+        labels, emb, ts = np.concatenate(labels), np.concatenate(emb), np.concatenate(ts)
+        k = min(self.nlist, len(labels))
+        self._centroids = _kmeans(emb, k)
+        self._lists = [FlatIndex() for _ in range(k)]
+        self._where = {}
+        assign = np.argmax(emb @ self._centroids.T, axis=1)
+        for label, vec, t, j in zip(labels, emb, ts, assign):
+            self._lists[int(j)].add(int(label), vec, float(t))
+            self._where[int(label)] = int(j)
+        self._trained_n = len(labels)
+
+    def add(self, label: int, vec: np.ndarray, ts: Optional[float] = None):
+        if label in self._where:
+            self.remove(label)
+        j = self._assign(vec)
+        self._lists[j].add(label, vec, ts)
+        self._where[label] = j
+        n = len(self._where)
+        if (self._centroids is None and n >= self.train_at) or \
+                (self._centroids is not None and n >= self.retrain_factor * self._trained_n):
+            self.train()
+
+    def remove(self, label: int) -> bool:
+        j = self._where.pop(label, None)
+        if j is None:
+            return False
+        return self._lists[j].remove(label)
+
+    def expire(self, cutoff: float) -> list[int]:
+        dead = []
+        for lst in self._lists:
+            dead.extend(lst.expire(cutoff))
+        for label in dead:
+            del self._where[label]
+        return dead
+
+    def oldest(self) -> Optional[tuple[int, float]]:
+        heads = [o for o in (lst.oldest() for lst in self._lists) if o is not None]
+        return min(heads, key=lambda o: o[1]) if heads else None
+
+    def search(self, q: np.ndarray, k: int = 1) -> tuple[np.ndarray, np.ndarray]:
+        if self._centroids is None:
+            return self._lists[0].search(q, k)
+        cs = self._centroids @ q
+        nprobe = min(self.nprobe, len(cs))
+        probe = np.argpartition(-cs, nprobe - 1)[:nprobe]
+        found = [self._lists[int(j)].search(q, k) for j in probe]
+        labels = np.concatenate([f[0] for f in found])
+        sims = np.concatenate([f[1] for f in found])
+        if not len(labels):
+            return labels, sims
+        top = np.argsort(-sims)[:k]
+        return labels[top], sims[top]
+
+
+def _benchmark(n: int = 100_000, dim: int = 384, queries: int = 500, nlist: int = 256):
+    rng = np.random.default_rng(7)
+    centers = rng.standard_normal((nlist, dim)).astype(np.float32)
+    data = centers[rng.integers(0, nlist, n)] + 0.6 * rng.standard_normal((n, dim)).astype(np.float32)
+    data /= np.linalg.norm(data, axis=1, keepdims=True)
+    # queries are perturbed copies of cached rows, i.e. paraphrases of cached prompts
+    qs = data[rng.integers(0, n, queries)] + 0.3 * rng.standard_normal((queries, dim)).astype(np.float32)
+    qs /= np.linalg.norm(qs, axis=1, keepdims=True)
+
+    flat, ivf = FlatIndex(), IVFFlatIndex(nlist=nlist)
+    for i, v in enumerate(data):
+        flat.add(i, v)
+        ivf.add(i, v)
+
+    t = time.perf_counter()
+    truth = [int(flat.search(q)[0][0]) for q in qs]
+    flat_ms = (time.perf_counter() - t) / queries * 1e3
+    print(f"n={n} dim={dim} nlist={nlist}")
+    print(f"{'index':<14}{'recall@1':>10}{'ms/query':>10}")
+    print(f"{'flat':<14}{1.0:>10.3f}{flat_ms:>10.3f}")
+    for nprobe in (1, 2, 4, 8, 16, 32):
+        ivf.nprobe = nprobe
+        t = time.perf_counter()
+        got = [int(ivf.search(q)[0][0]) for q in qs]
+        ms = (time.perf_counter() - t) / queries * 1e3
+        recall = sum(a == b for a, b in zip(got, truth)) / queries
+        print(f"{f'ivf nprobe={nprobe}':<14}{recall:>10.3f}{ms:>10.3f}")
+
+
+if __name__ == "__main__":
+    _benchmark()
@@ -0,0 +1,200 @@
+"""Replay benchmark for the layered LLM caches.
+
+Replays a JSONL trace ({"prompt": ..., "system": ..., "group": ...} per line)
+against ExactCache, SemanticCache and LLMCache for every cache size / threshold
+in the grid, and writes one CSV row per run: hit rate, false hits, throughput,
+p50/p95/p99 lookup latency and the memory the cache holds afterwards.
+Prompts sharing a "group" are paraphrases with the same correct answer; a hit
+that returns another group's answer counts as a false hit.
+
+The LLM and the embedder are deterministic local stubs, so it runs offline and
+the numbers are comparable between commits. LLMCache additionally needs a
+Redis on localhost and is skipped if it is not reachable.
+
+    python cache_bench.py --trace prompts.jsonl --out bench.csv
+    python cache_bench.py --generate 5000          # synthetic paraphrase trace
+"""
+import argparse
+import csv
+import hashlib
+import json
+import random
+import re
+import time
+import tracemalloc
+
+import numpy as np
+
+from adaptive_threshold import AdaptiveThreshold
+from ann_index import normalize
+from caching_agents import ExactCache, SemanticCache, canonicalize
+
+FIELDS = ["cache", "size", "threshold", "requests", "hits", "hit_rate", "false_hits",
+          "throughput_rps", "p50_ms", "p95_ms", "p99_ms", "memory_kb"]
+
+
+class StubEmbedder:
+    """Feature-hashed bag of words + character trigrams: paraphrases that share
+    vocabulary land close together, unrelated prompts do not."""
+
+    def __init__(self, dim: int = 384):
+        self.dim = dim
+
+    def embed(self, text: str) -> np.ndarray:
+        v = np.zeros(self.dim, dtype=np.float32)
+        t = canonicalize(text)
+        grams = re.findall(r"\w+", t) + [t[i:i + 3] for i in range(len(t) - 2)]
+        for g in grams:
+            h = int.from_bytes(hashlib.blake2b(g.encode(), digest_size=8).digest(), "little")
+            v[h % self.dim] += 1.0 if (h >> 32) & 1 else -1.0
+        return normalize(v)
+
+
+def stub_llm(rec: dict) -> str:
+    ident = rec.get("group") or f"{rec.get('system', '')}\n\n{canonicalize(rec['prompt'])}"
+    return "answer-" + hashlib.sha256(ident.encode()).hexdigest()[:24]
+
+
+def load_trace(path: str) -> list[dict]:
+    with open(path) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+_SUBJECTS = ["the capital of Japan", "the size of the sun", "photosynthesis", "a binary heap",
+             "the French word for hello", "who wrote Romeo and Juliet", "TCP slow start",
+             "the boiling point of water", "a Redis sorted set", "the Pythagorean theorem"]
+_TEMPLATES = ["What is {}?", "Tell me about {}.", "Explain {} briefly", "what is {}",
+              "Can you describe {}?", "Give me a short summary of {}", "  What is {}??  "]
+
+
+def generate_trace(n: int, seed: int = 0) -> list[dict]:
+    """Zipf-popular subjects in varied phrasings, plus a tail of one-off prompts."""
+    rng = random.Random(seed)
+    weights = [1 / (i + 1) for i in range(len(_SUBJECTS))]
+    out = []
+    for i in range(n):
+        if rng.random() < 0.2:
+            out.append({"prompt": f"Unique question #{i}: {rng.random():.6f}"})
+        else:
+            subject = rng.choices(_SUBJECTS, weights)[0]
+            out.append({"prompt": rng.choice(_TEMPLATES).format(subject), "group": subject})
+    return out
+
+
+def _replay(trace: list[dict], lookup, store) -> tuple[list[float], int, int, float]:
+    lat, hits, false_hits = [], 0, 0
+    t0 = time.perf_counter()
+    for rec in trace:
+        prompt, system = rec["prompt"], rec.get("system", "")
+        ts = time.perf_counter()
+        hit = lookup(prompt, system)
+        lat.append(time.perf_counter() - ts)
+        if hit is not None:
+            hits += 1
+            false_hits += hit != stub_llm(rec)
+        else:
+            store(prompt, system, stub_llm(rec))
+    return lat, hits, false_hits, time.perf_counter() - t0
+
+
+def _run(name: str, size, threshold, trace: list[dict], make) -> dict:
+    lookup, store, _ = make()
+    lat, hits, false_hits, wall = _replay(trace, lookup, store)
+    # second pass under tracemalloc just for the footprint, so it doesn't skew latency
+    tracemalloc.start()
+    base = tracemalloc.get_traced_memory()[0]
+    lookup, store, keep = make()
+    _replay(trace, lookup, store)
+    mem = tracemalloc.get_traced_memory()[0] - base
+    tracemalloc.stop()
+    del keep
+    ms = np.array(lat) * 1e3
+    return {"cache": name, "size": size, "threshold": threshold, "requests": len(trace),
+            "hits": hits, "hit_rate": round(hits / len(trace), 4), "false_hits": false_hits,
+            "throughput_rps": round(len(trace) / wall, 1),
+            "p50_ms": round(float(np.percentile(ms, 50)), 4),
+            "p95_ms": round(float(np.percentile(ms, 95)), 4),
+            "p99_ms": round(float(np.percentile(ms, 99)), 4),
+            "memory_kb": round(mem / 1024, 1)}
+
+
+def _exact(size: int):
+    def make():
+        c = ExactCache(max_size=size)
+        return (lambda p, s: c.get(p, system=s),
+                lambda p, s, v: c.put(p, v, system=s), c)
+    return make
+
+
+def _fixed(threshold: float) -> AdaptiveThreshold:
+    # pinned: never collects enough samples to recalibrate, so the sweep stays put
+    return AdaptiveThreshold(default=threshold, min_samples=2 ** 62)
+
+
+def _semantic(size: int, threshold: float, embedder: StubEmbedder):
+    def make():
+        c = SemanticCache(threshold=threshold, max_size=size, embedder=embedder,
+                          thresholds=_fixed(threshold))
+        full = lambda p, s: f"{s}\n\n{p}" if s else p
+        return (lambda p, s: c.get(full(p, s))[0],
+                lambda p, s, v: c.put(full(p, s), v), c)
+    return make
+
+
+def _llm_cache(threshold: float, embedder: StubEmbedder):
+    from task2_semantic_cache import LLMCache
+
+    def make():
+        c = LLMCache(sim_threshold=threshold, embedder=embedder, prefix="bench_semantic_cache")
+        c.thresholds = _fixed(threshold)
+        c.clear()
+        full = lambda p, s: f"{s}\n\n{p}" if s else p
+        return (lambda p, s: c.search_cache(full(p, s))[0],
+                lambda p, s, v: c.add_to_cache(full(p, s), v), c)
+    return make
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    ap.add_argument("--trace", help="JSONL trace with a prompt (and optional system) per line")
+    ap.add_argument("--generate", type=int, default=2000, help="synthetic trace length if no --trace")
+    ap.add_argument("--sizes", default="64,256,1024")
+    # the stub embedder scores paraphrases ~0.65-0.8, lower than a real model would
+    ap.add_argument("--thresholds", default="0.6,0.7,0.75,0.8,0.9")
+    ap.add_argument("--out", default="cache_bench.csv")
+    ap.add_argument("--no-redis", action="store_true", help="skip LLMCache")
+    args = ap.parse_args()
+
+    trace = load_trace(args.trace) if args.trace else generate_trace(args.generate)
+    sizes = [int(s) for s in args.sizes.split(",")]
+    thresholds = [float(t) for t in args.thresholds.split(",")]
+    embedder = StubEmbedder()
+
+    rows = []
+    for size in sizes:
+        rows.append(_run("exact", size, "", trace, _exact(size)))
+        for t in thresholds:
+            rows.append(_run("semantic", size, t, trace, _semantic(size, t, embedder)))
+    if not args.no_redis:
+        try:
+            for t in thresholds:
+                rows.append(_run("llm_cache", "", t, trace, _llm_cache(t, embedder)))
+        except Exception as e:
+            print(f"skipping LLMCache: {e}")
+
+    with open(args.out, "w", newline="") as f:
+        w = csv.DictWriter(f, fieldnames=FIELDS)
+        w.writeheader()
+        w.writerows(rows)
+
+    print(f"{len(trace)} requests -> {args.out}")
+    print(f"{'cache':<10}{'size':>6}{'thr':>6}{'hit%':>8}{'false':>7}{'rps':>10}"
+          f"{'p50ms':>9}{'p99ms':>9}{'memKB':>10}")
+    for r in rows:
+        print(f"{r['cache']:<10}{r['size']:>6}{r['threshold']:>6}{r['hit_rate']*100:>8.1f}"
+              f"{r['false_hits']:>7}{r['throughput_rps']:>10.0f}{r['p50_ms']:>9.3f}"
+              f"{r['p99_ms']:>9.3f}{r['memory_kb']:>10.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,11 +1,18 @@
-import os, json, time, hashlib, math
-from typing import Optional
+import os, json, time, hashlib, threading, asyncio, sqlite3, bisect, unicodedata
+from collections import OrderedDict
+from concurrent.futures import Future
+from typing import Callable, Optional
 
+import numpy as np
 from fastapi import FastAPI, Request
-from fastapi.responses import HTMLResponse, StreamingResponse
+from fastapi.responses import HTMLResponse, PlainTextResponse, StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
 import uvicorn
-from openai import OpenAI
+from openai import AsyncOpenAI, OpenAI
+
+from adaptive_threshold import AdaptiveThreshold, prompt_bucket
+from ann_index import FlatIndex
+from embedding_service import EmbeddingService, get_embedding_service
 
 # use ollama here
 _client: Optional[OpenAI] = None
@@ -20,136 +27,686 @@ def get_client() -> OpenAI:
     return _client
 
 
+_async_client: Optional[AsyncOpenAI] = None
+
+def get_async_client() -> AsyncOpenAI:
+    global _async_client
+    if _async_client is None:
+        key = os.environ.get("OPENAI_API_KEY", "")
+        if not key:
+            raise EnvironmentError("Set OPENAI_API_KEY environment variable.")
+        _async_client = AsyncOpenAI(api_key=key)
+    return _async_client
+
+
+# Second tier under both caches: one SQLite file in WAL mode, so it survives
+# restarts and is shared by every uvicorn worker on the host. Each thread gets
+# its own connection; nothing touches the file until the first lookup.
+class DiskTier:
+    def __init__(self, path: str = "agent_cache.db", ttl: int = 900):
+        self.path = path
+        self.ttl = ttl
+        self._local = threading.local()
+        self._puts = 0
+
+    def _conn(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=5)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.executescript("""
+                CREATE TABLE IF NOT EXISTS exact (
+                    key TEXT PRIMARY KEY, value TEXT NOT NULL, prompt TEXT, ts REAL NOT NULL);
+                CREATE TABLE IF NOT EXISTS semantic (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT, prompt TEXT, value TEXT NOT NULL,
+                    emb BLOB NOT NULL, ts REAL NOT NULL);
+                CREATE INDEX IF NOT EXISTS exact_ts ON exact(ts);
+                CREATE INDEX IF NOT EXISTS semantic_ts ON semantic(ts);
+            """)
+            self._local.conn = conn
+        return conn
+
+    def get_exact(self, key: str) -> Optional[tuple[str, str, float]]:
+        """Returns (value, prompt, ts) if the key is on disk and fresh."""
+        return self._conn().execute(
+            "SELECT value, prompt, ts FROM exact WHERE key = ? AND ts > ?",
+            (key, time.time() - self.ttl)).fetchone()
+
+    def put_exact(self, key: str, prompt: str, value: str, ts: float):
+        with self._conn() as c:
+            c.execute("INSERT OR REPLACE INTO exact (key, value, prompt, ts) VALUES (?, ?, ?, ?)",
+                      (key, value, prompt, ts))
+        self._maybe_prune()
+
+    def put_semantic(self, prompt: str, value: str, emb: np.ndarray, ts: float) -> int:
+        with self._conn() as c:
+            cur = c.execute("INSERT INTO semantic (prompt, value, emb, ts) VALUES (?, ?, ?, ?)",
+                            (prompt, value, emb.astype(np.float32).tobytes(), ts))
+        self._maybe_prune()
+        return cur.lastrowid
+
+    def semantic_since(self, after_id: int, limit: int) -> list[tuple]:
+        """Newest `limit` fresh rows with id > after_id, oldest first."""
+        rows = self._conn().execute(
+            "SELECT id, prompt, value, emb, ts FROM semantic WHERE id > ? AND ts > ? "
+            "ORDER BY id DESC LIMIT ?", (after_id, time.time() - self.ttl, limit)).fetchall()
+        return rows[::-1]
+
+    def _maybe_prune(self):
+        self._puts += 1
+        if self._puts % 256:
+            return
+        cutoff = time.time() - self.ttl
+        with self._conn() as c:
+            c.execute("DELETE FROM exact WHERE ts <= ?", (cutoff,))
+            c.execute("DELETE FROM semantic WHERE ts <= ?", (cutoff,))
+
+    @property
+    def stats(self):
+        c = self._conn()
+        return {"path": self.path,
+                "exact_rows": c.execute("SELECT COUNT(*) FROM exact").fetchone()[0],
+                "semantic_rows": c.execute("SELECT COUNT(*) FROM semantic").fetchone()[0]}
+
+
+_STOP_WORDS = frozenset("""a an the please kindly can could would you me i to of for
+in on at is are be just""".split())
+_TRAILING = " \t\n.!?;,:"
+
+
+def canonicalize(text: str, strip_stopwords: bool = False) -> str:
+    """Folds cheap variants of a prompt together: Unicode NFKC, casefold,
+    whitespace runs collapsed, trailing punctuation dropped."""
+    t = " ".join(unicodedata.normalize("NFKC", text).casefold().split()).rstrip(_TRAILING)
+    if strip_stopwords:
+        t = " ".join(w for w in t.split(" ") if w not in _STOP_WORDS)
+    return t
+
+
 # replace using redis or similar for actual use in homework
+# LRU over an OrderedDict: hits move to the back, eviction pops the front, so
+# get/put are O(1). TTL is sliding (a hit refreshes ts), which keeps the dict in
+# ts order too, so expired entries are always at the front and drop lazily.
+# Lookups run on worker threads, so the dict is only touched under _lock; disk
+# reads and writes happen outside it.
 class ExactCache:
-    def __init__(self, max_size=256, ttl=900):
-        self.store: dict[str, dict] = {}
+    def __init__(self, max_size=256, ttl=900, max_bytes: Optional[int] = None,
+                 disk: Optional[DiskTier] = None, strip_stopwords: bool = False):
+        self.store: OrderedDict[str, dict] = OrderedDict()
+        self.strip_stopwords = strip_stopwords
         self.max_size = max_size
+        self.max_bytes = max_bytes
         self.ttl = ttl
+        self.disk = disk
+        self._lock = threading.Lock()
+        self.bytes = 0
         self.hits = 0
+        self.disk_hits = 0
         self.misses = 0
-
-    def _key(self, prompt: str, model: str) -> str:
-        return hashlib.sha256(f"{model}::{prompt}".encode()).hexdigest()[:16]
-
-    def get(self, prompt: str, model: str = "gpt-4o-mini") -> Optional[str]:
-        k = self._key(prompt, model)
-        e = self.store.get(k)
-        if e and (time.time() - e["ts"] < self.ttl):
-            self.hits += 1
-            e["ts"] = time.time()
-            return e["value"]
-        if e:
-            del self.store[k]
-        self.misses += 1
+        self.evictions = 0
+
+    def _key(self, prompt: str, model: str, system: str = "",
+             temperature: Optional[float] = None) -> str:
+        # the user part is canonicalized (stop words optional); the system prompt
+        # only needs identity, so it is canonicalized without stripping
+        sys_id = hashlib.sha256(canonicalize(system).encode()).hexdigest()[:16] if system else ""
+        user = canonicalize(prompt, self.strip_stopwords)
+        return hashlib.sha256(f"{model}::{temperature}::{sys_id}::{user}".encode()).hexdigest()[:16]
+
+    @staticmethod
+    def _sizeof(key: str, value: str, prompt: str) -> int:
+        return len(key) + len(value.encode()) + len(prompt.encode())
+
+    def _drop(self, k: str):
+        e = self.store.pop(k)
+        self.bytes -= e["size"]
+
+    def _expire(self, now: float):
+        while self.store:
+            k, e = next(iter(self.store.items()))
+            if now - e["ts"] < self.ttl:
+                break
+            self._drop(k)
+
+    def get(self, prompt: str, model: str = "gpt-4o-mini", system: str = "",
+            temperature: Optional[float] = None) -> Optional[str]:
+        k = self._key(prompt, model, system, temperature)
+        now = time.time()
+        with self._lock:
+            e = self.store.get(k)
+            if e and (now - e["ts"] < self.ttl):
+                self.hits += 1
+                e["ts"] = now
+                self.store.move_to_end(k)
+                return e["value"]
+            if e:
+                self._drop(k)
+        if self.disk:
+            row = self.disk.get_exact(k)
+            if row:
+                # promote: a disk hit is hot again, so it moves up to the memory tier
+                with self._lock:
+                    self.hits += 1
+                    self.disk_hits += 1
+                    self._insert(k, row[0], row[1] or "", now)
+                return row[0]
+        with self._lock:
+            self.misses += 1
         return None
 
-    def put(self, prompt: str, value: str, model: str = "gpt-4o-mini"):
-        k = self._key(prompt, model)
-        if len(self.store) >= self.max_size:
-            oldest = min(self.store, key=lambda x: self.store[x]["ts"])
-            del self.store[oldest]
-        self.store[k] = {"value": value, "ts": time.time(), "prompt": prompt[:100]}
+    def put(self, prompt: str, value: str, model: str = "gpt-4o-mini", system: str = "",
+            temperature: Optional[float] = None):
+        k = self._key(prompt, model, system, temperature)
+        now = time.time()
+        with self._lock:
+            self._insert(k, value, prompt[:100], now)
+        if self.disk:
+            self.disk.put_exact(k, prompt[:100], value, now)
+
+    def _insert(self, k: str, value: str, short: str, now: float):
+        if k in self.store:
+            self._drop(k)
+        self._expire(now)
+        size = self._sizeof(k, value, short)
+        if self.max_bytes is not None and size > self.max_bytes:
+            return
+        while self.store and (len(self.store) >= self.max_size or
+                              (self.max_bytes is not None and self.bytes + size > self.max_bytes)):
+            self._drop(next(iter(self.store)))
+            self.evictions += 1
+        self.store[k] = {"value": value, "ts": now, "prompt": short, "size": size}
+        self.bytes += size
 
     @property
     def stats(self):
-        t = self.hits + self.misses
-        return {"entries": len(self.store), "hits": self.hits, "misses": self.misses,
-                "hit_rate": f"{self.hits/t*100:.1f}%" if t else "0%"}
-
-
-# in your homework please use better matching
-def _cosine(a: list[float], b: list[float]) -> float:
-    dot = sum(x * y for x, y in zip(a, b))
-    na = math.sqrt(sum(x * x for x in a))
-    nb = math.sqrt(sum(x * x for x in b))
-    return dot / (na * nb) if na and nb else 0.0
-
-
+        with self._lock:
+            t = self.hits + self.misses
+            return {"entries": len(self.store), "hits": self.hits, "misses": self.misses,
+                    "hit_rate": f"{self.hits/t*100:.1f}%" if t else "0%",
+                    "bytes": self.bytes, "evictions": self.evictions, "disk_hits": self.disk_hits}
+
+
+# `index` is any ann_index structure (FlatIndex = exact scan, IVFFlatIndex =
+# approximate, tune recall with .nprobe); the cache keeps values by label.
+# `threshold` is only the starting cutoff: each prompt bucket gets its own,
+# calibrated from near-misses whose fresh answer is compared to the neighbour's,
+# and from sampled hits whose cached answer is compared to a live one.
+# The index and entries are guarded by _lock; embedding happens outside it.
 class SemanticCache:
     """Returns a hit when a new query's embedding cosine similarity
     to a cached query is >= threshold."""
 
-    def __init__(self, threshold: float = 0.92, max_size: int = 128, ttl: int = 900):
-        self.entries: list[dict] = []
+    def __init__(self, threshold: float = 0.92, max_size: int = 128, ttl: int = 900,
+                 index=None, embedder: Optional[EmbeddingService] = None,
+                 disk: Optional[DiskTier] = None, sync_interval: float = 1.0,
+                 thresholds: Optional[AdaptiveThreshold] = None, agree: float = 0.9):
+        self.index = index if index is not None else FlatIndex()
+        self.embedder = embedder if embedder is not None else get_embedding_service()
+        self.entries: dict[int, dict] = {}
         self.threshold = threshold
+        self.thresholds = (thresholds if thresholds is not None
+                           else AdaptiveThreshold(default=threshold, agree=agree))
         self.max_size = max_size
         self.ttl = ttl
+        self._lock = threading.Lock()
         self.hits = 0
         self.misses = 0
+        self._next = 0
+        # with a disk tier, labels are its row ids; other workers' rows are pulled
+        # in at most every sync_interval seconds, and the first lookup warm-loads
+        self.disk = disk
+        self.sync_interval = sync_interval
+        self._disk_seen = 0
+        self._synced_at = 0.0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def _embed(self, text: str) -> np.ndarray:
+        return self.embedder.embed(text)
+
+    def _expire(self, now: float):
+        for label in self.index.expire(now - self.ttl):
+            del self.entries[label]
+
+    def _sync(self, now: float, dim: int):
+        if not self.disk or now - self._synced_at < self.sync_interval:
+            return
+        self._synced_at = now
+        for rid, prompt, value, emb, ts in self.disk.semantic_since(self._disk_seen, self.max_size):
+            self._disk_seen = max(self._disk_seen, rid)
+            # rows written under another embedding model have another width
+            if rid in self.entries or now - ts >= self.ttl or len(emb) != 4 * dim:
+                continue
+            self._make_room()
+            self.index.add(rid, np.frombuffer(emb, dtype=np.float32), ts)
+            self.entries[rid] = {"prompt": prompt, "value": value}
+
+    def _make_room(self):
+        if len(self.entries) >= self.max_size:
+            label, _ = self.index.oldest()
+            self.index.remove(label)
+            del self.entries[label]
 
-    def _embed(self, text: str) -> list[float]:
-        resp = get_client().embeddings.create(input=text, model="text-embedding-3-small")
-        return resp.data[0].embedding
-
-    def get(self, prompt: str) -> tuple[Optional[str], float]:
+    def get(self, prompt: str, bucket: str = "default") -> tuple[Optional[str], float]:
         """Returns (cached_value | None, best_similarity)."""
+        q = self._embed(prompt)
         now = time.time()
-        self.entries = [e for e in self.entries if now - e["ts"] < self.ttl]
-        if not self.entries:
-            self.misses += 1
-            return None, 0.0
+        with self._lock:
+            self._sync(now, len(q))
+            self._expire(now)
+            labels, sims = self.index.search(q) if self.entries else ((), ())
+            best_sim = float(sims[0]) if len(labels) else 0.0
+            hit = bool(len(labels)) and best_sim >= self.thresholds.threshold(bucket)
+            value = self.entries[int(labels[0])]["value"] if hit else None
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+        self.thresholds.observe_lookup(bucket, hit)
+        return value, best_sim
+
+    def _near_miss(self, emb: np.ndarray, bucket: str) -> Optional[tuple[float, str]]:
+        # (similarity, answer) of the nearest cached neighbour if it is worth
+        # labelling; called under _lock
+        labels, sims = self.index.search(emb)
+        if not len(labels) or not self.thresholds.wants_label(bucket, float(sims[0])):
+            return None
+        neighbour = self.entries.get(int(labels[0]))
+        return (float(sims[0]), neighbour["value"]) if neighbour else None
+
+    def _label_near_miss(self, near: tuple[float, str], value: str, bucket: str):
+        # the prompt just missed and was answered live: would its nearest cached
+        # neighbour's answer have done? agreeing answers mean a false miss
+        sim, neighbour_value = near
+        self.thresholds.label(bucket, sim, neighbour_value, value, self._embed)
+
+    def label_hit(self, bucket: str, sim: float, cached: str, live: str):
+        """Labels a shadowed hit: disagreeing answers mean a false hit."""
+        self.thresholds.label(bucket, sim, cached, live, self._embed)
+
+    def put(self, prompt: str, value: str, bucket: str = "default"):
         emb = self._embed(prompt)
-        best_sim, best_val = 0.0, None
-        for e in self.entries:
-            sim = _cosine(emb, e["embedding"])
-            if sim > best_sim:
-                best_sim = sim
-                best_val = e["value"]
-        if best_sim >= self.threshold:
-            self.hits += 1
-            return best_val, best_sim
-        self.misses += 1
-        return None, best_sim
-
-    def put(self, prompt: str, value: str):
-        if len(self.entries) >= self.max_size:
-            self.entries.sort(key=lambda e: e["ts"])
-            self.entries = self.entries[len(self.entries)//4:]
-        emb = self._embed(prompt)
-        self.entries.append({"embedding": emb, "prompt": prompt[:120],
-                             "value": value, "ts": time.time()})
+        now = time.time()
+        with self._lock:
+            self._sync(now, len(emb))
+            self._expire(now)
+            near = self._near_miss(emb, bucket) if self.entries else None
+        if near:
+            self._label_near_miss(near, value, bucket)
+        label = self.disk.put_semantic(prompt[:120], value, emb, now) if self.disk else None
+        with self._lock:
+            if label is None:
+                label, self._next = self._next, self._next + 1
+            elif label in self.entries:
+                return  # another thread's _sync already pulled the row in
+            self._make_room()
+            self.index.add(label, emb, now)
+            self.entries[label] = {"prompt": prompt[:120], "value": value}
 
     @property
     def stats(self):
-        t = self.hits + self.misses
-        return {"entries": len(self.entries), "hits": self.hits, "misses": self.misses,
-                "hit_rate": f"{self.hits/t*100:.1f}%" if t else "0%",
-                "threshold": self.threshold}
+        with self._lock:
+            t = self.hits + self.misses
+            out = {"entries": len(self.entries), "hits": self.hits, "misses": self.misses,
+                   "hit_rate": f"{self.hits/t*100:.1f}%" if t else "0%", "threshold": self.threshold}
+        return {**out, "buckets": self.thresholds.stats["buckets"]}
+
+
+# Single-flight: the first caller for a key runs the call, and everyone asking
+# for the same key while it is in flight waits on that caller's future instead
+# of issuing a duplicate completion. Works for threads and coroutines alike.
+class SingleFlight:
+    def __init__(self):
+        self._calls: dict[str, Future] = {}
+        self._tasks: set[asyncio.Task] = set()
+        self._lock = threading.Lock()
+        self.leaders = 0
+        self.coalesced = 0
+
+    def _join(self, key: str) -> tuple[Future, bool]:
+        with self._lock:
+            fut = self._calls.get(key)
+            if fut is not None:
+                self.coalesced += 1
+                return fut, False
+            fut = self._calls[key] = Future()
+            self.leaders += 1
+            return fut, True
+
+    def _finish(self, key: str, fut: Future, result=None, exc: Optional[BaseException] = None):
+        with self._lock:
+            del self._calls[key]
+        if fut.cancelled():
+            return
+        if exc is not None:
+            fut.set_exception(exc)
+        else:
+            fut.set_result(result)
+
+    def do(self, key: str, fn):
+        """Returns (result, led) where led is False for a coalesced wait."""
+        fut, lead = self._join(key)
+        if not lead:
+            return fut.result(), False
+        try:
+            result = fn()
+        except BaseException as e:
+            self._finish(key, fut, exc=e)
+            raise
+        self._finish(key, fut, result)
+        return result, True
+
+    async def ado(self, key: str, fn):
+        fut, lead = self._join(key)
+        if not lead:
+            # shielded: a cancelled follower must not cancel the shared future
+            return await asyncio.shield(asyncio.wrap_future(fut)), False
+        # the call runs as its own task, so cancelling the leader (say its SSE
+        # client went away) leaves it running for the followers on fut
+        task = asyncio.ensure_future(fn())
+        self._tasks.add(task)
+        task.add_done_callback(lambda t: self._settle(key, fut, t))
+        return await asyncio.shield(task), True
+
+    def _settle(self, key: str, fut: Future, task: asyncio.Task):
+        self._tasks.discard(task)
+        if task.cancelled():
+            self._finish(key, fut, exc=asyncio.CancelledError())
+        elif task.exception() is not None:
+            self._finish(key, fut, exc=task.exception())
+        else:
+            self._finish(key, fut, task.result())
+
+    @property
+    def stats(self):
+        return {"in_flight": len(self._calls), "leaders": self.leaders,
+                "coalesced": self.coalesced}
+
+
+class Histogram:
+    """Fixed-bucket histogram; `counts[i]` holds observations <= bounds[i]
+    that did not fit a smaller bucket, the last slot is +Inf."""
+
+    def __init__(self, bounds: tuple[float, ...]):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, v: float):
+        self.counts[bisect.bisect_left(self.bounds, v)] += 1
+        self.sum += v
+        self.count += 1
+
+    def quantile(self, q: float) -> Optional[float]:
+        """Upper bound of the bucket holding the q-quantile (None past the last bound)."""
+        if not self.count:
+            return None
+        seen = 0
+        for bound, n in zip(self.bounds, self.counts):
+            seen += n
+            if seen >= q * self.count:
+                return bound
+        return None
+
+    def snapshot(self) -> dict:
+        return {"count": self.count, "sum": round(self.sum, 6),
+                "buckets": {str(b): n for b, n in zip(self.bounds + ("+Inf",), self.counts)},
+                "p50": self.quantile(0.5), "p95": self.quantile(0.95), "p99": self.quantile(0.99)}
+
+    def prometheus(self, name: str, labels: str = "") -> list[str]:
+        sep = "," if labels else ""
+        lines, seen = [], 0
+        for b, n in zip(self.bounds + ("+Inf",), self.counts):
+            seen += n
+            lines.append(f'{name}_bucket{{{labels}{sep}le="{b}"}} {seen}')
+        tail = f"{{{labels}}}" if labels else ""
+        lines.append(f"{name}_sum{tail} {self.sum}")
+        lines.append(f"{name}_count{tail} {self.count}")
+        return lines
+
+
+LATENCY_BUCKETS = (0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+SIMILARITY_BUCKETS = (0.5, 0.6, 0.7, 0.75, 0.8, 0.85, 0.88, 0.9, 0.92, 0.94, 0.96, 0.98, 1.0)
+
+
+# Per-tier latency of llm_call/allm_call, the best similarity seen on semantic
+# misses (how close the near-misses were to `threshold`), and token/time
+# savings: each hit is credited with the average live call as of that hit, so
+# the totals only grow.
+class CacheMetrics:
+    tiers = ("exact", "semantic", "coalesced", "live")
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.latency = {t: Histogram(LATENCY_BUCKETS) for t in self.tiers}
+        self.near_miss = Histogram(SIMILARITY_BUCKETS)
+        self.live_tokens = 0
+        self.live_with_usage = 0
+        self.tokens_saved = 0.0
+        self.seconds_saved = 0.0
+
+    def _averages(self) -> tuple[float, float]:
+        live = self.latency["live"]
+        avg_s = live.sum / live.count if live.count else 0.0
+        avg_tok = self.live_tokens / self.live_with_usage if self.live_with_usage else 0.0
+        return avg_s, avg_tok
+
+    def observe(self, status: str, seconds: float):
+        tier = status.split(" ")[0]
+        with self._lock:
+            self.latency[tier].observe(seconds)
+            if tier != "live":
+                # a hit saves a live call's tokens, and its time minus the lookup's own
+                avg_s, avg_tok = self._averages()
+                self.tokens_saved += avg_tok
+                self.seconds_saved += max(0.0, avg_s - seconds)
+
+    def observe_near_miss(self, sim: float):
+        with self._lock:
+            self.near_miss.observe(sim)
+
+    def observe_usage(self, total_tokens: Optional[int]):
+        if total_tokens is None:
+            return
+        with self._lock:
+            self.live_tokens += total_tokens
+            self.live_with_usage += 1
+
+    def savings(self) -> dict:
+        avg_s, avg_tok = self._averages()
+        return {"avg_live_seconds": round(avg_s, 4), "avg_live_tokens": round(avg_tok, 1),
+                "tokens_saved": round(self.tokens_saved), "seconds_saved": round(self.seconds_saved, 2)}
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return {"latency": {t: h.snapshot() for t, h in self.latency.items()},
+                    "near_miss_similarity": self.near_miss.snapshot(),
+                    "embedding_batches": embedder.batches, "embedded_texts": embedder.embedded,
+                    "savings": self.savings()}
+
+    def prometheus(self) -> str:
+        with self._lock:
+            out = ["# HELP llm_call_seconds llm_call latency by cache tier.",
+                   "# TYPE llm_call_seconds histogram"]
+            for t, h in self.latency.items():
+                out += h.prometheus("llm_call_seconds", f'tier="{t}"')
+            out += ["# HELP semantic_near_miss_similarity Best cosine similarity on semantic misses.",
+                    "# TYPE semantic_near_miss_similarity histogram"]
+            out += self.near_miss.prometheus("semantic_near_miss_similarity")
+            s = self.savings()
+        counters = [
+            ("embedding_batches_total", "Batches run by the embedding service.", embedder.batches),
+            ("embedding_texts_total", "Texts embedded by the embedding service.", embedder.embedded),
+            ("llm_tokens_saved_total", "Estimated tokens saved by cache hits.", s["tokens_saved"]),
+            ("llm_seconds_saved_total", "Estimated seconds saved by cache hits.", s["seconds_saved"]),
+        ]
+        for name, help_, v in counters:
+            out += [f"# HELP {name} {help_}", f"# TYPE {name} counter", f"{name} {v}"]
+        out += ["# HELP cache_entries Entries held in memory.", "# TYPE cache_entries gauge",
+                f'cache_entries{{cache="exact"}} {len(exact_cache.store)}',
+                f'cache_entries{{cache="semantic"}} {len(semantic_cache)}',
+                "# HELP cache_lookups_total Cache lookups by result.", "# TYPE cache_lookups_total counter"]
+        for name, c in (("exact", exact_cache), ("semantic", semantic_cache)):
+            out += [f'cache_lookups_total{{cache="{name}",result="hit"}} {c.hits}',
+                    f'cache_lookups_total{{cache="{name}",result="miss"}} {c.misses}']
+        return "\n".join(out) + "\n"
+
+
+# AGENT_CACHE_DB="" turns the on-disk tier off
+_cache_db = os.environ.get("AGENT_CACHE_DB", "agent_cache.db")
+disk_tier = DiskTier(_cache_db) if _cache_db else None
+exact_cache = ExactCache(disk=disk_tier)
+# local model by default (EMBED_BACKEND=openai for the API), shared with LLMCache
+embedder = get_embedding_service()
+semantic_cache = SemanticCache(threshold=0.92, embedder=embedder, disk=disk_tier)
+if os.environ.get("SEMANTIC_REPLAY"):
+    semantic_cache.thresholds.replay_file(os.environ["SEMANTIC_REPLAY"])
+# share of semantic hits re-asked live to catch false hits; off by default, each costs a call
+semantic_cache.thresholds.shadow_rate = float(os.environ.get("SEMANTIC_SHADOW_RATE", "0"))
+inflight = SingleFlight()
+metrics = CacheMetrics()
+
+
+def _bucket(full: str, system: str, kind: str) -> str:
+    # the prompt class is the agent role if given, else which system prompt it used
+    if not kind and system:
+        kind = hashlib.sha256(system.encode()).hexdigest()[:8]
+    return prompt_bucket(kind, full)
+
+
+def _cache_lookup(prompt: str, system: str, model: str, temperature: float,
+                  bucket: str = "default") -> Optional[tuple[str, str]]:
+    hit = exact_cache.get(prompt, model, system, temperature)
+    if hit:
+        return hit, "exact"
+    full = f"{system}\n\n{prompt}" if system else prompt
+    sem_hit, sim = semantic_cache.get(full, bucket)
+    if sem_hit:
+        exact_cache.put(prompt, sem_hit, model, system, temperature)
+        if semantic_cache.thresholds.wants_shadow():
+            semantic_cache.thresholds.shadow(_shadow_verify, prompt, system, model, temperature,
+                                             bucket, sim, sem_hit)
+        return sem_hit, f"semantic ({sim:.0%})"
+    if sim > 0:
+        metrics.observe_near_miss(sim)
+    return None
+
+
+def _shadow_verify(prompt: str, system: str, model: str, temperature: float, bucket: str,
+                   sim: float, cached: str):
+    # a sampled semantic hit is answered live as well, off the request path; only
+    # these samples can show a false hit and push a bucket's threshold up
+    resp = get_client().chat.completions.create(model=model, messages=_messages(prompt, system),
+                                                temperature=temperature, max_tokens=1024)
+    metrics.observe_usage(resp.usage.total_tokens if resp.usage else None)
+    semantic_cache.label_hit(bucket, sim, cached, resp.choices[0].message.content.strip())
+
+
+def _cache_store(prompt: str, system: str, model: str, temperature: float, text: str,
+                 bucket: str = "default"):
+    exact_cache.put(prompt, text, model, system, temperature)
+    full = f"{system}\n\n{prompt}" if system else prompt
+    semantic_cache.put(full, text, bucket)
 
 
-exact_cache = ExactCache()
-semantic_cache = SemanticCache(threshold=0.92)
+def _messages(prompt: str, system: str) -> list[dict]:
+    msgs = []
+    if system:
+        msgs.append({"role": "system", "content": system})
+    msgs.append({"role": "user", "content": prompt})
+    return msgs
 
 
 # LLM call with layered caching: check exact cache  check semantic cache  call LLM. Returns (text, cache_status).
 def llm_call(prompt: str, system: str = "", model: str = "gpt-4o-mini",
-             temperature: float = 0.7, use_cache: bool = True) -> tuple[str, str]:
-    """Returns (text, cache_status).  status ∈ {exact, semantic (NN%), live}."""
+             temperature: float = 0.7, use_cache: bool = True, kind: str = "") -> tuple[str, str]:
+    """Returns (text, cache_status).  status ∈ {exact, semantic (NN%), live, coalesced}."""
     full = f"{system}\n\n{prompt}" if system else prompt
+    bucket = _bucket(full, system, kind)
+    t0 = time.perf_counter()
 
     if use_cache:
-        hit = exact_cache.get(full, model)
+        hit = _cache_lookup(prompt, system, model, temperature, bucket)
         if hit:
-            return hit, "exact"
-        sem_hit, sim = semantic_cache.get(full)
-        if sem_hit:
-            exact_cache.put(full, sem_hit, model)
-            return sem_hit, f"semantic ({sim:.0%})"
-
-    client = get_client()
-    msgs = []
-    if system:
-        msgs.append({"role": "system", "content": system})
-    msgs.append({"role": "user", "content": prompt})
-    resp = client.chat.completions.create(model=model, messages=msgs,
-                                          temperature=temperature, max_tokens=1024)
-    text = resp.choices[0].message.content.strip()
+            metrics.observe(hit[1], time.perf_counter() - t0)
+            return hit
+
+    def live() -> str:
+        resp = get_client().chat.completions.create(model=model, messages=_messages(prompt, system),
+                                                    temperature=temperature, max_tokens=1024)
+        metrics.observe_usage(resp.usage.total_tokens if resp.usage else None)
+        text = resp.choices[0].message.content.strip()
+        if use_cache:
+            _cache_store(prompt, system, model, temperature, text, bucket)
+        return text
+
+    if not use_cache:
+        text, status = live(), "live"
+    else:
+        # the leader fills the caches before waking followers, so later arrivals hit
+        text, led = inflight.do(exact_cache._key(prompt, model, system, temperature), live)
+        status = "live" if led else "coalesced"
+    metrics.observe(status, time.perf_counter() - t0)
+    return text, status
+
+
+# Async twin of llm_call. The cache tiers may wait on an embedding batch,
+# so they run in a worker thread; the completion itself uses AsyncOpenAI.
+# With on_delta set, a live completion is streamed and each token delta is
+# passed to it as it arrives; cached and coalesced results arrive as one delta.
+async def allm_call(prompt: str, system: str = "", model: str = "gpt-4o-mini",
+                    temperature: float = 0.7, use_cache: bool = True,
+                    on_delta: Optional[Callable[[str], None]] = None, kind: str = "") -> tuple[str, str]:
+    full = f"{system}\n\n{prompt}" if system else prompt
+    bucket = _bucket(full, system, kind)
+    t0 = time.perf_counter()
 
     if use_cache:
-        exact_cache.put(full, text, model)
-        semantic_cache.put(full, text)
-    return text, "live"
+        hit = await asyncio.to_thread(_cache_lookup, prompt, system, model, temperature, bucket)
+        if hit:
+            metrics.observe(hit[1], time.perf_counter() - t0)
+            if on_delta:
+                on_delta(hit[0])
+            return hit
+
+    async def live() -> str:
+        client = get_async_client()
+        if on_delta is None:
+            resp = await client.chat.completions.create(
+                model=model, messages=_messages(prompt, system),
+                temperature=temperature, max_tokens=1024)
+            metrics.observe_usage(resp.usage.total_tokens if resp.usage else None)
+            text = resp.choices[0].message.content.strip()
+        else:
+            stream = await client.chat.completions.create(
+                model=model, messages=_messages(prompt, system),
+                temperature=temperature, max_tokens=1024, stream=True,
+                stream_options={"include_usage": True})
+            parts = []
+            async for chunk in stream:
+                if getattr(chunk, "usage", None):
+                    metrics.observe_usage(chunk.usage.total_tokens)
+                delta = chunk.choices[0].delta.content if chunk.choices else None
+                if delta:
+                    parts.append(delta)
+                    on_delta(delta)
+            text = "".join(parts).strip()
+        if use_cache:
+            await asyncio.to_thread(_cache_store, prompt, system, model, temperature, text, bucket)
+        return text
+
+    if not use_cache:
+        text, status = await live(), "live"
+    else:
+        text, led = await inflight.ado(exact_cache._key(prompt, model, system, temperature), live)
+        if not led and on_delta:
+            on_delta(text)
+        status = "live" if led else "coalesced"
+    metrics.observe(status, time.perf_counter() - t0)
+    return text, status
 
 
 # ──────────────────────────────────────────────
@@ -164,10 +721,13 @@ def _safe_json(raw: str) -> dict:
     return json.loads(c.strip())
 
 
-def plan(goal: str) -> dict:
+async def plan(goal: str, on_delta: Optional[Callable[[str], None]] = None) -> dict:
     sys = ("You are a planning agent. Decompose the goal into 3-5 ordered sub-tasks. "
-           "Return ONLY valid JSON: {\"plan\":[{\"step\":1,\"task\":\"...\",\"reasoning\":\"...\"}]}")
-    raw, st = llm_call(goal, system=sys, temperature=0.4)
+           "For each step list in depends_on the earlier step numbers whose output it needs "
+           "([] if it can be done independently). "
+           "Return ONLY valid JSON: {\"plan\":[{\"step\":1,\"task\":\"...\",\"reasoning\":\"...\",\"depends_on\":[]}]}")
+    raw, st = await allm_call(goal, system=sys, temperature=0.4, on_delta=on_delta,
+                              kind="plan")
     try:
         data = _safe_json(raw)
     except Exception:
@@ -176,20 +736,24 @@ def plan(goal: str) -> dict:
     return data
 
 
-def execute_step(task: str, context: str = "") -> dict:
+async def execute_step(task: str, context: str = "",
+                       on_delta: Optional[Callable[[str], None]] = None) -> dict:
     sys = "You are an execution agent. Complete the task concisely. Build on prior context if given."
     prompt = f"Task: {task}"
     if context:
         prompt += f"\n\nPrior context:\n{context}"
-    result, st = llm_call(prompt, system=sys, temperature=0.5)
+    result, st = await allm_call(prompt, system=sys, temperature=0.5, on_delta=on_delta,
+                                 kind="execute")
     return {"result": result, "_cache": st}
 
 
-def reflect(goal: str, results: list[str]) -> dict:
+async def reflect(goal: str, results: list[str],
+                  on_delta: Optional[Callable[[str], None]] = None) -> dict:
     sys = ("You are a reflection agent. Evaluate the work vs the goal. "
            "Return ONLY valid JSON: {\"score\":1-10,\"strengths\":[...],\"gaps\":[...],\"suggestions\":[...]}")
     prompt = f"Goal: {goal}\n\nWork:\n" + "\n---\n".join(results)
-    raw, st = llm_call(prompt, system=sys, temperature=0.3)
+    raw, st = await allm_call(prompt, system=sys, temperature=0.3, on_delta=on_delta,
+                              kind="reflect")
     try:
         data = _safe_json(raw)
     except Exception:
@@ -205,35 +769,128 @@ def _sse(event: str, data: dict) -> str:
     return f"event: {event}\ndata: {json.dumps(data)}\n\n"
 
 
-def stream_agent(goal: str):
+AGENT_FANOUT = int(os.environ.get("AGENT_FANOUT", "4"))
+
+
+def _step_deps(steps: list, i: int) -> list[int]:
+    """Indices of the earlier steps step i needs. Without a usable depends_on
+    a step is assumed to need the one before it, i.e. the sequential order."""
+    deps = steps[i].get("depends_on") if isinstance(steps[i], dict) else None
+    if not isinstance(deps, list):
+        return [i - 1] if i else []
+    nums = [s.get("step") if isinstance(s, dict) else None for s in steps[:i]]
+    return sorted({nums.index(d) for d in deps if d in nums})
+
+
+def _step_context(steps: list, i: int) -> list[int]:
+    """Step i's dependencies and theirs, transitively, in step order: the
+    results its prompt is built from (every earlier step for a plan without
+    depends_on)."""
+    need = set(_step_deps(steps, i))
+    for j in range(i - 1, -1, -1):
+        if j in need:
+            need.update(_step_deps(steps, j))
+    return sorted(need)
+
+
+async def _forward(events: asyncio.Queue, task: asyncio.Task):
+    """Yields queued events until `task` finishes, then whatever is left."""
+    while not task.done():
+        getter = asyncio.ensure_future(events.get())
+        await asyncio.wait({getter, task}, return_when=asyncio.FIRST_COMPLETED)
+        if getter.done():
+            yield getter.result()
+        else:
+            getter.cancel()
+    while not events.empty():
+        yield events.get_nowait()
+
+
+async def stream_agent(goal: str, fanout: int = AGENT_FANOUT, stream: bool = True):
     t0 = time.time()
+    # token deltas from every phase land here, tagged so they can be forwarded as SSE
+    events: asyncio.Queue = asyncio.Queue()
+
+    def deltas(phase: str, index: Optional[int] = None):
+        if not stream:
+            return None
+        return lambda d: events.put_nowait(("delta", index, {"phase": phase, "index": index, "delta": d}))
 
     # ── PLAN
     yield _sse("phase", {"phase": "plan", "message": "Decomposing goal into sub-tasks…"})
     tp = time.time()
-    plan_data = plan(goal)
+    job = asyncio.create_task(plan(goal, on_delta=deltas("plan")))
+    async for _, _, payload in _forward(events, job):
+        yield _sse("delta", payload)
+    plan_data = job.result()
     yield _sse("plan", {**plan_data, "_time": round(time.time() - tp, 2)})
 
     # ── EXECUTE
-    ctx = ""
-    results = []
+    # every step is a task that waits for its dependencies, then for a fan-out
+    # slot; step events are still yielded in plan order as results come in
     steps = plan_data.get("plan", [])
-    for i, item in enumerate(steps):
-        task = item.get("task", str(item))
-        yield _sse("phase", {"phase": "execute",
-                              "message": f"Step {i+1}/{len(steps)}: {task[:90]}…",
-                              "step": i+1, "total": len(steps)})
-        te = time.time()
-        res = execute_step(task, ctx)
-        results.append(res["result"])
-        ctx += f"\n• {task}: {res['result'][:200]}"
-        yield _sse("step", {"index": i, "task": task, "result": res["result"],
-                            "_cache": res["_cache"], "_time": round(time.time() - te, 2)})
+    tasks = [item.get("task", str(item)) if isinstance(item, dict) else str(item) for item in steps]
+    done = [asyncio.get_running_loop().create_future() for _ in steps]
+    slots = asyncio.Semaphore(max(1, fanout))
+
+    async def run(i: int):
+        try:
+            deps = _step_context(steps, i)
+            prior = [await done[d] for d in deps]
+            ctx = "".join(f"\n• {tasks[d]}: {r[:200]}" for d, r in zip(deps, prior))
+            async with slots:
+                await events.put(("start", i, None))
+                te = time.time()
+                res = await execute_step(tasks[i], ctx, on_delta=deltas("execute", i))
+            done[i].set_result(res["result"])
+            await events.put(("step", i, {**res, "_time": round(time.time() - te, 2)}))
+        except Exception as e:
+            if not done[i].done():
+                done[i].set_exception(e)
+            await events.put(("error", i, e))
+        except BaseException:
+            # cancelled: still tell the consumer, or it waits on events forever
+            done[i].cancel()
+            events.put_nowait(("error", i, RuntimeError(f"step {i+1} was cancelled")))
+            raise
+
+    workers = [asyncio.create_task(run(i)) for i in range(len(steps))]
+    results: dict[int, dict] = {}
+    emitted = 0
+    try:
+        while emitted < len(steps):
+            kind, i, payload = await events.get()
+            if kind == "error":
+                raise payload
+            if kind == "delta":
+                yield _sse("delta", payload)
+                continue
+            if kind == "start":
+                yield _sse("phase", {"phase": "execute",
+                                     "message": f"Step {i+1}/{len(steps)}: {tasks[i][:90]}…",
+                                     "step": i+1, "total": len(steps)})
+                continue
+            results[i] = payload
+            while emitted in results:
+                res = results[emitted]
+                yield _sse("step", {"index": emitted, "task": tasks[emitted], "result": res["result"],
+                                    "_cache": res["_cache"], "_time": res["_time"]})
+                emitted += 1
+    finally:
+        for w in workers:
+            w.cancel()
+        for f in done:
+            if f.done() and not f.cancelled():
+                f.exception()
 
     # ── REFLECT
     yield _sse("phase", {"phase": "reflect", "message": "Reflecting on work quality…"})
     tr = time.time()
-    ref = reflect(goal, results)
+    job = asyncio.create_task(reflect(goal, [results[i]["result"] for i in range(len(steps))],
+                                      on_delta=deltas("reflect")))
+    async for _, _, payload in _forward(events, job):
+        yield _sse("delta", payload)
+    ref = job.result()
     yield _sse("reflect", {**ref, "_time": round(time.time() - tr, 2)})
 
     # ── DONE
@@ -241,6 +898,7 @@ def stream_agent(goal: str):
         "total_time": round(time.time() - t0, 2),
         "exact_cache": exact_cache.stats,
         "semantic_cache": semantic_cache.stats,
+        "single_flight": inflight.stats,
     })
 
 
@@ -252,12 +910,13 @@ app.add_middleware(CORSMiddleware, allow_origins=["*"], allow_methods=["*"], all
 
 
 @app.get("/api/stream")
-async def api_stream(goal: str = ""):
+async def api_stream(goal: str = "", fanout: int = AGENT_FANOUT, stream: bool = True):
     if not goal:
         return {"error": "No goal"}
-    def gen():
+    async def gen():
         try:
-            yield from stream_agent(goal)
+            async for ev in stream_agent(goal, fanout, stream):
+                yield ev
         except Exception as e:
             yield _sse("error", {"message": str(e)})
     return StreamingResponse(gen(), media_type="text/event-stream",
@@ -266,7 +925,15 @@ async def api_stream(goal: str = ""):
 
 @app.get("/api/cache")
 async def api_cache():
-    return {"exact": exact_cache.stats, "semantic": semantic_cache.stats}
+    return {"exact": exact_cache.stats, "semantic": semantic_cache.stats,
+            "embeddings": embedder.stats, "single_flight": inflight.stats,
+            "disk": disk_tier.stats if disk_tier else None,
+            "metrics": metrics.snapshot()}
+
+
+@app.get("/metrics", response_class=PlainTextResponse)
+async def prometheus_metrics():
+    return metrics.prometheus()
 
 
 @app.get("/", response_class=HTMLResponse)
@@ -431,10 +1098,17 @@ function esc(s){const d=document.createElement('div');d.textContent=s;return d.i
 function badgeFor(c){
   if(!c)return'';
   if(c==='exact')return'<span class="bg exact">EXACT HIT</span>';
+  if(c==='coalesced')return'<span class="bg exact">COALESCED</span>';
   if(c.startsWith('semantic'))return`<span class="bg semantic">${esc(c.toUpperCase())}</span>`;
   return'<span class="bg live">LIVE CALL</span>';
 }
 
+// final cards replace the card their streamed deltas were rendered into
+function place(id,html){
+  const lv=$(id);
+  if(lv) lv.outerHTML=html; else $('feed').insertAdjacentHTML('beforeend',html);
+}
+
 function tlog(msg,cls=''){
   const log=$('tlog');
   log.classList.add('show');
@@ -472,12 +1146,29 @@ function run(){
     tlog(d.message,'c-phase');
   });
 
+  src.addEventListener('delta',e=>{
+    const d=JSON.parse(e.data);
+    const id='live-'+d.phase+(d.index??'');
+    let el=$(id);
+    if(!el){
+      const ic=d.phase==='plan'?'pl':d.phase==='reflect'?'rf':'ex';
+      const lbl=d.phase==='execute'?`Step ${d.index+1}`:d.phase==='plan'?'Planning':'Reflection';
+      $('feed').insertAdjacentHTML('beforeend',`
+        <div class="card" id="${id}">
+          <div class="ch"><span class="ic ${ic}">…</span><span class="lbl">${lbl}</span><span class="bg live">STREAMING</span></div>
+          <div class="cb"><p></p></div>
+        </div>`);
+      el=$(id);
+    }
+    el.querySelector('.cb p').textContent+=d.delta;
+  });
+
   src.addEventListener('plan',e=>{
     const d=JSON.parse(e.data);
     const inner=(d.plan||[]).map(s=>
       `<div class="stp"><div class="stp-h"><span class="stp-n">0${s.step}</span><span class="stp-t">${esc(s.task)}</span></div><p class="stp-r">${esc(s.reasoning||'')}</p></div>`
     ).join('');
-    $('feed').insertAdjacentHTML('beforeend',`
+    place('live-plan',`
       <div class="card">
         <div class="ch"><span class="ic pl">P</span><span class="lbl">Planning</span>${badgeFor(d._cache)}<span class="bg tm">${d._time}s</span></div>
         <div class="cb">${inner}</div>
@@ -490,7 +1181,7 @@ function run(){
     const d=JSON.parse(e.data);
     const pf=$('progFill');
     if(pf) pf.style.width=Math.round((d.index+1)/totalSteps*100)+'%';
-    $('feed').insertAdjacentHTML('beforeend',`
+    place('live-execute'+d.index,`
       <div class="card">
         <div class="ch"><span class="ic ex">${d.index+1}</span><span class="lbl">${esc(d.task)}</span>${badgeFor(d._cache)}<span class="bg tm">${d._time}s</span></div>
         <div class="cb"><p>${esc(d.result)}</p></div>
@@ -504,7 +1195,7 @@ function run(){
     const str=(d.strengths||[]).map(s=>`<li>${esc(s)}</li>`).join('');
     const gap=(d.gaps||[]).map(s=>`<li>${esc(s)}</li>`).join('');
     const sug=(d.suggestions||[]).map(s=>`<li>${esc(s)}</li>`).join('');
-    $('feed').insertAdjacentHTML('beforeend',`
+    place('live-reflect',`
       <div class="card">
         <div class="ch"><span class="ic rf">R</span><span class="lbl">Reflection</span>${badgeFor(d._cache)}<span class="bg tm">${d._time}s</span></div>
         <div class="cb"><div class="ref-g">
@@ -1,16 +1,110 @@
 import sqlite3
 import redis
 import json
+import math
+import random
+import secrets
 import time
+import threading
+import weakref
+from collections import OrderedDict
 from typing import Optional, List, Dict
 
-class DatabaseWithCache:
-    def __init__(self, db_name="demo.db", redis_host="localhost", redis_port=6379):
-        self.conn = sqlite3.connect(db_name)
-        self.conn.row_factory = sqlite3.Row
-        self.cursor = self.conn.cursor()
+# KEYS are the generation counter, n tag sets, then the n gen:{tag} keys. Stamps
+# each tag with a new generation (ARGV[2] seconds TTL) so fills that read the
+# counter before this are refused by CACHE_SET_LUA, deletes every cached key the
+# sets list and the sets themselves, and announces the dropped keys on channel
+# ARGV[1] for near-caches to evict
+INVALIDATE_TAGS_LUA = """
+local n = (#KEYS - 1) / 2
+local gen = redis.call('INCR', KEYS[1])
+local deleted, dropped = 0, {}
+for t = 2, n + 1 do
+    redis.call('SET', KEYS[t + n], gen, 'EX', ARGV[2])
+    local keys = redis.call('SMEMBERS', KEYS[t])
+    for i = 1, #keys, 500 do
+        deleted = deleted + redis.call('DEL', unpack(keys, i, math.min(i + 499, #keys)))
+    end
+    redis.call('DEL', KEYS[t])
+    for _, key in ipairs(keys) do
+        dropped[#dropped + 1] = key
+    end
+end
+if #dropped > 0 then
+    redis.call('PUBLISH', ARGV[1], table.concat(dropped, '\\n'))
+end
+return {deleted, dropped}
+"""
+
+# KEYS are the cached key, n tag sets, then the n gen:{tag} keys; ARGV is the
+# generation read before loading, the TTL, the value and the tag-set TTL. Writes
+# nothing if a tag was invalidated since, so a reader holding a pre-update row
+# can't put it back after update_user
+CACHE_SET_LUA = """
+local n = (#KEYS - 1) / 2
+for t = 2, n + 1 do
+    if tonumber(redis.call('GET', KEYS[t + n]) or '0') > tonumber(ARGV[1]) then
+        return 0
+    end
+end
+redis.call('SET', KEYS[1], ARGV[3], 'EX', ARGV[2])
+for t = 2, n + 1 do
+    redis.call('SADD', KEYS[t], KEYS[1])
+    redis.call('EXPIRE', KEYS[t], ARGV[4])
+end
+return 1
+"""
+
+INVALIDATION_CHANNEL = "cache:invalidate"
+GENERATION_KEY = "cache:gen"
+
+# deletes a lock only if it still holds our token: a holder that outlived its
+# PX must not drop the lock another worker has taken since
+RELEASE_LOCK_LUA = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+
+
+class _ThreadConn:
+    # a thread's SQLite connection and cursor; lives only in that thread's
+    # threading.local slot, so it is collected when the thread exits
+    def __init__(self, conn):
+        self.conn = conn
+        self.cursor = conn.cursor()
+
+
+def _close_conn(conn, conns, lock):
+    with lock:
+        if conn in conns:
+            conns.remove(conn)
+    conn.close()
+
+
+def xfetch_due(delta, expiry, beta=1.0, now=None):
+    # XFetch: refresh before expiry with a probability that rises as expiry nears,
+    # earlier for values that took longer (delta seconds) to compute
+    now = time.time() if now is None else now
+    return now - delta * beta * math.log(1.0 - random.random()) >= expiry
+
 
-        self.redis_client = redis.Redis(host=redis_host, port=redis_port, decode_responses=True)
+class DatabaseWithCache:
+    def __init__(self, db_name="demo.db", redis_host="localhost", redis_port=6379,
+                 view_flush_interval=1.0, max_redis_connections=32,
+                 near_cache_size=0, near_cache_ttl=2.0):
+        # one SQLite connection per thread (see conn), one shared Redis pool;
+        # threads block for a free Redis connection instead of opening more
+        self.db_name = db_name
+        self._local = threading.local()
+        self._conns = []
+        self._conns_lock = threading.Lock()
+
+        self.redis_pool = redis.BlockingConnectionPool(
+            host=redis_host, port=redis_port, decode_responses=True,
+            max_connections=max_redis_connections, timeout=5)
+        self.redis_client = redis.Redis(connection_pool=self.redis_pool)
         try:
             self.redis_client.ping()
             print("Connected to Redis")
@@ -20,6 +114,72 @@ class DatabaseWithCache:
 
         self._setup_database()
 
+        # derived keys are registered in tag sets (tag:user:{id}, tag:city:{name});
+        # invalidating a tag drops every key in its set in one atomic script
+        # gen:{tag} only has to outlive a load that started before the invalidation
+        self.tag_ttl = 86400
+        self.gen_ttl = 600
+        self._invalidate_tags = self.redis_client.register_script(INVALIDATE_TAGS_LUA)
+        self._set_tagged = self.redis_client.register_script(CACHE_SET_LUA)
+
+        # values are stored as {"v", "delta", "exp"} envelopes and kept stale_ttl
+        # seconds past exp, so while one worker holds lock:{key} and recomputes,
+        # the others keep serving the old value instead of piling onto SQLite
+        self.xfetch_beta = 1.0
+        self.stale_ttl = 60
+        self.lock_ms = 2000
+        self.stampede_stats = {"hits": 0, "recomputes": 0, "early_refreshes": 0,
+                               "stale_served": 0, "lock_waits": 0}
+        self._release_lock = self.redis_client.register_script(RELEASE_LOCK_LUA)
+
+        # optional in-process L1 for user:{id}: bounded LRU with a short TTL, kept
+        # coherent by the keys invalidate_tags publishes; the TTL caps staleness
+        # if a message is missed or a fill races an invalidation
+        self.near_cache_size = near_cache_size
+        self.near_cache_ttl = near_cache_ttl
+        self._near = OrderedDict()
+        self._near_lock = threading.Lock()
+        self.near_stats = {"hits": 0, "misses": 0, "invalidations": 0}
+        self._pubsub_thread = None
+        if near_cache_size:
+            self._pubsub = self.redis_client.pubsub(ignore_subscribe_messages=True)
+            self._pubsub.subscribe(**{INVALIDATION_CHANNEL: self._on_invalidate})
+            self._pubsub_thread = self._pubsub.run_in_thread(sleep_time=0.1, daemon=True)
+
+        # write-behind view counts: increments only touch Redis, a background
+        # thread copies dirty counters into SQLite every view_flush_interval seconds
+        self.view_flush_interval = view_flush_interval
+        self.view_flush_stats = {"flushes": 0, "rows_flushed": 0, "last_batch": 0,
+                                 "max_batch": 0, "last_lag": 0.0, "max_lag": 0.0}
+        self._flush_lock = threading.Lock()
+        self._stop_flusher = threading.Event()
+        self._flusher = threading.Thread(target=self._flush_loop, daemon=True)
+        self._flusher.start()
+
+    @property
+    def conn(self):
+        return self._thread_conn().conn
+
+    @property
+    def cursor(self):
+        return self._thread_conn().cursor
+
+    def _thread_conn(self):
+        tc = getattr(self._local, "tc", None)
+        if tc is None:
+            # sqlite3 keeps prepared statements per connection, keyed by SQL text,
+            # so the fixed query strings below are only compiled once per thread
+            conn = sqlite3.connect(self.db_name, check_same_thread=False, cached_statements=256)
+            conn.row_factory = sqlite3.Row
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            with self._conns_lock:
+                self._conns.append(conn)
+            tc = self._local.tc = _ThreadConn(conn)
+            # closed when its thread exits, so pool churn doesn't pile up connections
+            weakref.finalize(tc, _close_conn, conn, self._conns, self._conns_lock)
+        return tc
+
     def _setup_database(self):
         self.cursor.execute("""
             CREATE TABLE IF NOT EXISTS users (
@@ -64,70 +224,281 @@ class DatabaseWithCache:
             return dict(row)
         return None
 
+    def _near_get(self, key):
+        with self._near_lock:
+            entry = self._near.get(key)
+            if entry is None or entry[0] < time.monotonic():
+                self.near_stats["misses"] += 1
+                return None
+            self._near.move_to_end(key)
+            self.near_stats["hits"] += 1
+            return entry[1]
+
+    def _near_put(self, key, value):
+        with self._near_lock:
+            self._near[key] = (time.monotonic() + self.near_cache_ttl, value)
+            self._near.move_to_end(key)
+            while len(self._near) > self.near_cache_size:
+                self._near.popitem(last=False)
+
+    def _near_evict(self, keys):
+        with self._near_lock:
+            for key in keys:
+                if self._near.pop(key, None) is not None:
+                    self.near_stats["invalidations"] += 1
+
+    def _on_invalidate(self, message):
+        if message["data"] == "*":
+            with self._near_lock:
+                self._near.clear()
+        else:
+            self._near_evict(message["data"].split("\n"))
+
     def get_user_by_id_with_cache(self, user_id, ttl=300):
         cache_key = f"user:{user_id}"
-        cached_data = self.redis_client.get(cache_key)
-
-        if cached_data:
+        if self.near_cache_size:
+            user_data = self._near_get(cache_key)
+            if user_data is not None:
+                print(f"  NEAR-CACHE HIT for user {user_id}")
+                return user_data
+
+        def load():
+            time.sleep(0.1)
+            self.cursor.execute("SELECT * FROM users WHERE id = ?", (user_id,))
+            row = self.cursor.fetchone()
+            return dict(row) if row else None
+
+        user_data, status = self._read_through(cache_key, ttl, load,
+                                               lambda u: [f"user:{user_id}"])
+        # stale values stay out of L1, they are about to be replaced
+        if self.near_cache_size and user_data is not None and status != "stale":
+            self._near_put(cache_key, user_data)
+        if status == "hit":
             print(f"  CACHE HIT for user {user_id}")
-            return json.loads(cached_data)
-
-        print(f"  CACHE MISS for user {user_id} - querying database")
-        time.sleep(0.1)
-        self.cursor.execute("SELECT * FROM users WHERE id = ?", (user_id,))
-        row = self.cursor.fetchone()
-
-        if row:
-            user_data = dict(row)
-            self.redis_client.setex(cache_key, ttl, json.dumps(user_data))
+        elif status == "stale":
+            print(f"  STALE HIT for user {user_id} - refresh in progress elsewhere")
+        elif user_data is not None and status != "waited":
+            print(f"  CACHE {status.upper()} for user {user_id} - queried database")
             print(f"  Cached user {user_id} for {ttl} seconds")
-            return user_data
-
-        return None
+        return user_data
+
+    def _read_through(self, key, ttl, load, tags):
+        # returns (value, status); status is hit, stale, waited, miss or refresh
+        stats = self.stampede_stats
+        raw, gen = self.redis_client.mget(key, GENERATION_KEY)
+        envelope = json.loads(raw) if raw else None
+        if envelope and not xfetch_due(envelope["delta"], envelope["exp"], self.xfetch_beta):
+            stats["hits"] += 1
+            return envelope["v"], "hit"
+
+        lock, token = f"lock:{key}", secrets.token_hex(8)
+        if self.redis_client.set(lock, token, nx=True, px=self.lock_ms):
+            try:
+                start = time.time()
+                value = load()
+                if value is not None:
+                    self._cache_set(key, ttl, value, tags(value), gen, delta=time.time() - start)
+            finally:
+                self._release_lock(keys=[lock], args=[token])
+            stats["recomputes"] += 1
+            if envelope and start < envelope["exp"]:
+                stats["early_refreshes"] += 1
+            return value, "refresh" if envelope else "miss"
+
+        if envelope:
+            stats["stale_served"] += 1
+            return envelope["v"], "stale"
+        # cold key that another worker is already loading: wait for its write, but
+        # only while it holds the lock; a load that found nothing writes nothing
+        stats["lock_waits"] += 1
+        deadline = time.time() + self.lock_ms / 1000
+        while time.time() < deadline:
+            time.sleep(0.01)
+            pipe = self.redis_client.pipeline(transaction=False)
+            pipe.get(key)
+            pipe.exists(lock)
+            raw, locked = pipe.execute()
+            if raw:
+                return json.loads(raw)["v"], "waited"
+            if not locked:
+                break
+        return load(), "miss"
+
+    def get_users_by_ids(self, user_ids, ttl=300):
+        # cache-aside in bulk: one MGET, one IN query for the misses, one write pipeline;
+        # each distinct id is fetched once, the result lines up with the input
+        requested = list(user_ids)
+        user_ids = list(dict.fromkeys(requested))
+        if not user_ids:
+            return []
+        *cached, gen = self.redis_client.mget([f"user:{uid}" for uid in user_ids] + [GENERATION_KEY])
+        now = time.time()
+        envelopes = {uid: json.loads(data) for uid, data in zip(user_ids, cached) if data}
+        # past-exp envelopes are only kept around for stampede cover; reload them here
+        users = {uid: e["v"] for uid, e in envelopes.items() if e["exp"] > now}
+        missing = [uid for uid in user_ids if uid not in users]
+        round_trips = 1
+
+        if missing:
+            start = time.time()
+            time.sleep(0.1)
+            # pad to a power of two so a handful of IN (...) statements get reused
+            size = 1 << (len(missing) - 1).bit_length()
+            padded = missing + missing[-1:] * (size - len(missing))
+            placeholders = ",".join("?" * size)
+            self.cursor.execute(f"SELECT * FROM users WHERE id IN ({placeholders})", padded)
+            rows = [dict(row) for row in self.cursor.fetchall()]
+            delta = time.time() - start
+            round_trips += 1
+            if rows:
+                pipe = self.redis_client.pipeline(transaction=False)
+                for user_data in rows:
+                    self._cache_set(f"user:{user_data['id']}", ttl, user_data,
+                                    [f"user:{user_data['id']}"], gen, pipe, delta)
+                    users[user_data["id"]] = user_data
+                pipe.execute()
+                # redis-py checks SCRIPT EXISTS before running a pipeline with scripts
+                round_trips += 2
+
+        hits = len(user_ids) - len(missing)
+        self.last_bulk_stats = {"requested": len(user_ids), "hits": hits, "misses": len(missing),
+                                "hit_ratio": round(hits / len(user_ids), 3),
+                                "round_trips": round_trips}
+        print(f"  MGET {len(user_ids)} users: {hits} hits, {len(missing)} misses "
+              f"({hits / len(user_ids):.0%} hit ratio, {round_trips} round-trips)")
+        return [users.get(uid) for uid in requested]
 
     def get_users_by_city(self, city, use_cache=True, ttl=300):
-        cache_key = f"users:city:{city}"
-
-        if use_cache:
-            cached_data = self.redis_client.get(cache_key)
-            if cached_data:
-                print(f"  CACHE HIT for city '{city}'")
-                return json.loads(cached_data)
-            print(f"  CACHE MISS for city '{city}'")
-
-        time.sleep(0.15)
-        self.cursor.execute("SELECT * FROM users WHERE city = ?", (city,))
-        rows = self.cursor.fetchall()
-        users = [dict(row) for row in rows]
-
-        if use_cache:
-            self.redis_client.setex(cache_key, ttl, json.dumps(users))
+        def load():
+            time.sleep(0.15)
+            self.cursor.execute("SELECT * FROM users WHERE city = ?", (city,))
+            return [dict(row) for row in self.cursor.fetchall()]
+
+        if not use_cache:
+            return load()
+
+        users, status = self._read_through(
+            f"users:city:{city}", ttl, load,
+            lambda users: [f"city:{city}"] + [f"user:{u['id']}" for u in users])
+        if status == "hit":
+            print(f"  CACHE HIT for city '{city}'")
+        elif status == "stale":
+            print(f"  STALE HIT for city '{city}' - refresh in progress elsewhere")
+        elif status != "waited":
+            print(f"  CACHE {status.upper()} for city '{city}'")
             print(f"  Cached {len(users)} users for city '{city}'")
-
         return users
 
+    def _cache_set(self, key, ttl, value, tags, gen, pipe=None, delta=0.0):
+        # gen is GENERATION_KEY as read before the value was loaded; the write is
+        # dropped if any of its tags has been invalidated since. Tag sets outlive
+        # the keys they list; stale members are harmless to DEL
+        envelope = {"v": value, "delta": round(delta, 4), "exp": time.time() + ttl}
+        return self._set_tagged(keys=[key] + [f"tag:{t}" for t in tags] + [f"gen:{t}" for t in tags],
+                                args=[int(gen or 0), ttl + self.stale_ttl, json.dumps(envelope), self.tag_ttl],
+                                client=pipe)
+
+    def invalidate_tags(self, *tags):
+        if not tags:
+            return 0
+        deleted, dropped = self._invalidate_tags(
+            keys=[GENERATION_KEY] + [f"tag:{t}" for t in tags] + [f"gen:{t}" for t in tags],
+            args=[INVALIDATION_CHANNEL, self.gen_ttl])
+        # other processes evict on the published message; don't wait for ours
+        if self.near_cache_size:
+            self._near_evict(dropped)
+        return deleted
+
     def invalidate_user_cache(self, user_id):
-        cache_key = f"user:{user_id}"
-        result = self.redis_client.delete(cache_key)
+        # drops user:{id} and every query result that contained the user
+        result = self.invalidate_tags(f"user:{user_id}")
         if result:
-            print(f"Invalidated cache for user {user_id}")
+            print(f"Invalidated {result} cache entries for user {user_id}")
         else:
             print(f"No cache entry found for user {user_id}")
 
+    def update_user(self, user_id, **fields):
+        allowed = {"name", "email", "city", "age"}
+        if not fields or not set(fields) <= allowed:
+            raise ValueError(f"can only update {sorted(allowed)}")
+        self.cursor.execute("SELECT city FROM users WHERE id = ?", (user_id,))
+        row = self.cursor.fetchone()
+        if row is None:
+            return False
+        assignments = ", ".join(f"{name} = ?" for name in fields)
+        self.cursor.execute(f"UPDATE users SET {assignments} WHERE id = ?",
+                            (*fields.values(), user_id))
+        self.conn.commit()
+        # a move also changes the new city's list, which doesn't contain the user yet
+        tags = [f"user:{user_id}", f"city:{row['city']}"]
+        if "city" in fields:
+            tags.append(f"city:{fields['city']}")
+        result = self.invalidate_tags(*tags)
+        print(f"Updated user {user_id}, invalidated {result} cache entries")
+        return True
+
     def clear_all_cache(self):
         self.redis_client.flushdb()
+        self.redis_client.publish(INVALIDATION_CHANNEL, "*")
+        with self._near_lock:
+            self._near.clear()
         print("Cleared all cache data")
 
     def increment_post_views(self, post_id):
         key = f"views:post:{post_id}"
-        views = self.redis_client.incr(key)
+        # one round-trip: bump the counter, mark it dirty, note when dirt started
+        pipe = self.redis_client.pipeline(transaction=False)
+        pipe.incr(key)
+        pipe.sadd("views:dirty", post_id)
+        pipe.set("views:dirty_since", time.time(), nx=True)
+        return pipe.execute()[0]
+
+    def flush_views(self, conn=None):
+        with self._flush_lock:
+            return self._flush_views(conn or self.conn)
+
+    def _flush_views(self, conn):
+        # take the dirty set atomically; increments after this re-mark their post
+        pipe = self.redis_client.pipeline()
+        pipe.smembers("views:dirty")
+        pipe.get("views:dirty_since")
+        pipe.delete("views:dirty", "views:dirty_since")
+        post_ids, since, _ = pipe.execute()
+        if not post_ids:
+            return 0
+        post_ids = sorted(post_ids, key=int)
+
+        pipe = self.redis_client.pipeline(transaction=False)
+        for post_id in post_ids:
+            pipe.get(f"views:post:{post_id}")
+        counts = pipe.execute()
+        rows = [(int(views), int(post_id)) for post_id, views in zip(post_ids, counts) if views]
 
-        if views % 10 == 0:
-            self.cursor.execute("UPDATE users SET views = ? WHERE id = ?", (views, post_id))
-            self.conn.commit()
-            print("Synced views to database")
+        try:
+            with conn:
+                conn.executemany("UPDATE users SET views = ? WHERE id = ?", rows)
+        except sqlite3.Error:
+            # put them back so the next flush retries
+            self.redis_client.sadd("views:dirty", *post_ids)
+            raise
 
-        return views
+        stats = self.view_flush_stats
+        lag = time.time() - float(since) if since else 0.0
+        stats["flushes"] += 1
+        stats["rows_flushed"] += len(rows)
+        stats["last_batch"] = len(rows)
+        stats["max_batch"] = max(stats["max_batch"], len(rows))
+        stats["last_lag"] = round(lag, 3)
+        stats["max_lag"] = round(max(stats["max_lag"], lag), 3)
+        return len(rows)
+
+    def _flush_loop(self):
+        while not self._stop_flusher.wait(self.view_flush_interval):
+            try:
+                self.flush_views()
+            except (redis.RedisError, sqlite3.Error) as e:
+                print(f"View flush failed: {e}")
+        self.flush_views()
 
     def get_cache_stats(self):
         info = self.redis_client.info('stats')
@@ -138,8 +509,38 @@ class DatabaseWithCache:
         print(f"  Commands processed: {info.get('total_commands_processed', 'N/A')}")
 
     def close(self):
-        self.conn.close()
+        self._stop_flusher.set()
+        self._flusher.join()
+        if self._pubsub_thread:
+            self._pubsub_thread.stop()
+            self._pubsub.close()
+        with self._conns_lock:
+            for conn in self._conns:
+                conn.close()
+            self._conns.clear()
         self.redis_client.close()
+        self.redis_pool.disconnect()
+
+
+def benchmark_concurrent_reads(db, thread_counts=(1, 2, 4, 8), reads_per_thread=2000):
+    # raw point reads, without the simulated latency, from N threads at once
+    from concurrent.futures import ThreadPoolExecutor
+    db.get_users_by_ids(range(1, 11))
+    results = {}
+    for source in ("sqlite", "redis"):
+        for n in thread_counts:
+            def worker(seed):
+                for i in range(reads_per_thread):
+                    uid = (seed + i) % 10 + 1
+                    if source == "sqlite":
+                        db.conn.execute("SELECT * FROM users WHERE id = ?", (uid,)).fetchone()
+                    else:
+                        json.loads(db.redis_client.get(f"user:{uid}"))
+            start = time.time()
+            with ThreadPoolExecutor(n) as pool:
+                list(pool.map(worker, range(n)))
+            results[(source, n)] = n * reads_per_thread / (time.time() - start)
+    return results
 
 
 def run_demo():
@@ -241,6 +642,135 @@ def run_demo():
         elif i == 4 or i == 12 or i == 22:
             print("...")
 
+    print("\n[1000 views spread over all 10 posts]")
+    start = time.time()
+    for i in range(1000):
+        db.increment_post_views(i % 10 + 1)
+    print(f"Time: {time.time() - start:.3f} seconds (no SQLite writes on this path)")
+    db.flush_views()
+    db.cursor.execute("SELECT id, views FROM users ORDER BY id LIMIT 3")
+    print(f"Views in SQLite after flush: {[tuple(r) for r in db.cursor.fetchall()]}")
+    print(f"Flush stats: {db.view_flush_stats}")
+
+    print("\n" + "=" * 60)
+    print("DEMO 6: Dashboard Load - Bulk Multi-Get")
+    print("=" * 60)
+
+    db.clear_all_cache()
+    dashboard_ids = list(range(1, 11))
+
+    print("\n[One GET per user]")
+    start = time.time()
+    for uid in dashboard_ids:
+        db.get_user_by_id_with_cache(uid)
+    loop_time = time.time() - start
+    print(f"Time: {loop_time:.3f} seconds")
+
+    db.clear_all_cache()
+    print("\n[get_users_by_ids - all cache misses]")
+    start = time.time()
+    users = db.get_users_by_ids(dashboard_ids)
+    bulk_time = time.time() - start
+    print(f"Loaded {len(users)} users in {bulk_time:.3f} seconds")
+
+    print("\n[get_users_by_ids again - all cached]")
+    start = time.time()
+    users = db.get_users_by_ids(dashboard_ids)
+    print(f"Loaded {len(users)} users in {time.time() - start:.3f} seconds")
+    print(f"\nBulk cold load was {loop_time/bulk_time:.1f}x faster than the per-user loop")
+
+    print("\n" + "=" * 60)
+    print("DEMO 7: Tag-Based Invalidation")
+    print("=" * 60)
+
+    db.clear_all_cache()
+    print("\n[Cache user 6 and the New York and Boston lists]")
+    db.get_user_by_id_with_cache(6)
+    db.get_users_by_city("New York")
+    db.get_users_by_city("Boston")
+
+    print("\n[Move user 6 to Boston]")
+    db.update_user(6, city="Boston")
+
+    print("\n[Both city lists are fresh - no stale results]")
+    print(f"New York: {[u['name'] for u in db.get_users_by_city('New York')]}")
+    print(f"Boston: {[u['name'] for u in db.get_users_by_city('Boston')]}")
+    db.update_user(6, city="New York")
+
+    print("\n[A read that loaded user 6 before an update can't cache the old row]")
+    gen = db.redis_client.get(GENERATION_KEY)
+    old_row = db.get_user_by_id_no_cache(6)
+    db.update_user(6, age=old_row["age"] + 1)
+    written = db._cache_set("user:6", 300, old_row, ["user:6"], gen)
+    print(f"Late write of the old row {'stored' if written else 'refused'}; "
+          f"age is now {db.get_user_by_id_with_cache(6)['age']}")
+    db.update_user(6, age=old_row["age"])
+
+    print("\n" + "=" * 60)
+    print("DEMO 8: Stampede Protection")
+    print("=" * 60)
+
+    db.clear_all_cache()
+    db.get_user_by_id_with_cache(1)
+
+    print("\n[user:1 expires while another worker holds its refresh lock]")
+    envelope = json.loads(db.redis_client.get("user:1"))
+    envelope["exp"] = time.time() - 1
+    db.redis_client.set("user:1", json.dumps(envelope), ex=db.stale_ttl)
+    db.redis_client.set("lock:user:1", 1, px=db.lock_ms)
+    start = time.time()
+    for _ in range(5):
+        db.get_user_by_id_with_cache(1)
+    print(f"5 reads in {time.time() - start:.3f} seconds, no database queries")
+
+    print("\n[Lock released - the next read refreshes]")
+    db.redis_client.delete("lock:user:1")
+    db.get_user_by_id_with_cache(1)
+
+    print("\n[XFetch: share of 1000 reads that refresh early, delta = 0.1s]")
+    for remaining in (5.0, 1.0, 0.3, 0.1):
+        expiry = time.time() + remaining
+        due = sum(xfetch_due(0.1, expiry) for _ in range(1000))
+        print(f"  {remaining:>4}s before expiry: {due / 10:.1f}%")
+    print(f"Stampede stats: {db.stampede_stats}")
+
+    print("\n" + "=" * 60)
+    print("DEMO 9: Concurrent Reads (per-thread SQLite, pooled Redis)")
+    print("=" * 60)
+
+    results = benchmark_concurrent_reads(db)
+    print(f"\n{'threads':>8}{'sqlite reads/s':>16}{'redis reads/s':>16}")
+    for n in (1, 2, 4, 8):
+        print(f"{n:>8}{results[('sqlite', n)]:>16.0f}{results[('redis', n)]:>16.0f}")
+
+    print("\n" + "=" * 60)
+    print("DEMO 10: Near-Cache (in-process L1)")
+    print("=" * 60)
+
+    near = DatabaseWithCache(near_cache_size=1024, near_cache_ttl=2.0)
+    near.get_user_by_id_with_cache(1)
+    near.get_user_by_id_with_cache(1)
+
+    reads = 10000
+    start = time.perf_counter()
+    for _ in range(reads):
+        json.loads(near.redis_client.get("user:1"))
+    redis_us = (time.perf_counter() - start) / reads * 1e6
+    start = time.perf_counter()
+    for _ in range(reads):
+        near._near_get("user:1")
+    near_us = (time.perf_counter() - start) / reads * 1e6
+    print(f"\nRedis GET + json.loads: {redis_us:.1f} us/read")
+    print(f"Near-cache lookup:      {near_us:.2f} us/read")
+
+    print("\n[Another client invalidates user 1]")
+    db.invalidate_user_cache(1)
+    time.sleep(0.3)
+    print(f"user:1 still in this client's L1: {'user:1' in near._near}")
+    near.get_user_by_id_with_cache(1)
+    print(f"Near-cache stats: {near.near_stats}")
+    near.close()
+
     print("\n" + "=" * 60)
     db.close()
     print("Demo completed successfully!")
@@ -0,0 +1,186 @@
+"""Shared embedding service for the semantic caches.
+
+One process-wide `EmbeddingService` (see `get_embedding_service`) loads the
+model once and micro-batches requests: callers from any thread or coroutine
+queue their text, and a single worker thread waits up to `window` seconds for
+more texts before encoding them as one batch. Vectors come back L2-normalized
+float32 and are memoized by text hash.
+
+The default backend is a local SentenceTransformer (EMBED_MODEL, default
+all-MiniLM-L6-v2), so embedding costs a few milliseconds instead of a network
+round-trip. EMBED_BACKEND=openai switches to the remote API.
+
+With `quantized=True` the memo keeps int8 codes plus one float32 scale per
+vector (4x smaller); `embed` still returns dequantized float32.
+"""
+import asyncio
+import hashlib
+import os
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
+from typing import Callable, Optional
+
+import numpy as np
+
+Backend = Callable[[list[str]], np.ndarray]
+
+
+def sentence_transformer_backend(name: str = "all-MiniLM-L6-v2") -> Backend:
+    model = None
+
+    def encode(texts: list[str]) -> np.ndarray:
+        nonlocal model
+        if model is None:
+            from sentence_transformers import SentenceTransformer
+            model = SentenceTransformer(name)
+        return model.encode(texts, batch_size=len(texts), convert_to_numpy=True)
+
+    return encode
+
+
+def openai_backend(model: str = "text-embedding-3-small") -> Backend:
+    def encode(texts: list[str]) -> np.ndarray:
+        from openai import OpenAI
+        resp = OpenAI().embeddings.create(input=texts, model=model)
+        return np.array([d.embedding for d in sorted(resp.data, key=lambda d: d.index)])
+
+    return encode
+
+
+def quantize_int8(v: np.ndarray) -> tuple[np.ndarray, np.float32]:
+    scale = np.float32(np.abs(v).max() / 127) if v.size else np.float32(0)
+    if not scale:
+        return np.zeros(v.shape, dtype=np.int8), np.float32(1)
+    return np.round(v / scale).astype(np.int8), scale
+
+
+def dequantize_int8(q: np.ndarray, scale: np.float32) -> np.ndarray:
+    v = q.astype(np.float32) * scale
+    n = np.linalg.norm(v)
+    return v / n if n else v
+
+
+class EmbeddingService:
+    def __init__(self, backend: Backend, window: float = 0.002, max_batch: int = 64,
+                 memo_size: int = 4096, quantized: bool = False):
+        self.backend = backend
+        self.window = window
+        self.max_batch = max_batch
+        self.memo_size = memo_size
+        self.quantized = quantized
+        self._memo: OrderedDict[str, object] = OrderedDict()
+        self._pending: dict[str, Future] = {}
+        self._queue: list[tuple[str, str]] = []
+        self._cond = threading.Condition()
+        self._worker: Optional[threading.Thread] = None
+        self.memo_hits = 0
+        self.memo_misses = 0
+        self.coalesced = 0
+        self.batches = 0
+        self.embedded = 0
+        self.max_batch_seen = 0
+        self.encode_seconds = 0.0
+
+    @staticmethod
+    def _key(text: str) -> str:
+        return hashlib.sha256(text.encode()).hexdigest()
+
+    def _unpack(self, entry) -> np.ndarray:
+        return dequantize_int8(*entry) if self.quantized else entry
+
+    def _submit(self, text: str) -> Future:
+        k = self._key(text)
+        with self._cond:
+            entry = self._memo.get(k)
+            if entry is not None:
+                self._memo.move_to_end(k)
+                self.memo_hits += 1
+                fut = Future()
+                fut.set_result(self._unpack(entry))
+                return fut
+            self.memo_misses += 1
+            fut = self._pending.get(k)
+            if fut is not None:
+                self.coalesced += 1
+                return fut
+            fut = self._pending[k] = Future()
+            self._queue.append((k, text))
+            if self._worker is None:
+                self._worker = threading.Thread(target=self._run, name="embedding-service",
+                                                daemon=True)
+                self._worker.start()
+            self._cond.notify()
+            return fut
+
+    def embed(self, text: str) -> np.ndarray:
+        return self._submit(text).result()
+
+    async def aembed(self, text: str) -> np.ndarray:
+        return await asyncio.wrap_future(self._submit(text))
+
+    def embed_int8(self, text: str) -> tuple[np.ndarray, np.float32]:
+        return quantize_int8(self.embed(text))
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._queue:
+                    self._cond.wait()
+            # give concurrent callers a moment to join this batch
+            deadline = time.monotonic() + self.window
+            with self._cond:
+                while len(self._queue) < self.max_batch and time.monotonic() < deadline:
+                    self._cond.wait(deadline - time.monotonic())
+                batch = self._queue[:self.max_batch]
+                self._queue = self._queue[self.max_batch:]
+            t0 = time.perf_counter()
+            try:
+                vecs = np.asarray(self.backend([t for _, t in batch]), dtype=np.float32)
+                norms = np.linalg.norm(vecs, axis=1, keepdims=True)
+                vecs = vecs / np.where(norms == 0, 1, norms)
+            except Exception as e:
+                with self._cond:
+                    for k, _ in batch:
+                        self._pending.pop(k).set_exception(e)
+                continue
+            with self._cond:
+                self.batches += 1
+                self.embedded += len(batch)
+                self.max_batch_seen = max(self.max_batch_seen, len(batch))
+                self.encode_seconds += time.perf_counter() - t0
+                for (k, _), v in zip(batch, vecs):
+                    self._memo[k] = quantize_int8(v) if self.quantized else v
+                    self._pending.pop(k).set_result(self._unpack(self._memo[k]))
+                while len(self._memo) > self.memo_size:
+                    self._memo.popitem(last=False)
+
+    @property
+    def stats(self):
+        t = self.memo_hits + self.memo_misses
+        return {"memo_entries": len(self._memo), "memo_hits": self.memo_hits,
+                "memo_misses": self.memo_misses,
+                "memo_hit_rate": f"{self.memo_hits/t*100:.1f}%" if t else "0%",
+                "coalesced": self.coalesced, "batches": self.batches,
+                "avg_batch": round(self.embedded / self.batches, 2) if self.batches else 0,
+                "max_batch": self.max_batch_seen,
+                "avg_batch_ms": round(self.encode_seconds / self.batches * 1e3, 2) if self.batches else 0,
+                "quantized": self.quantized}
+
+
+_service: Optional[EmbeddingService] = None
+_service_lock = threading.Lock()
+
+
+def get_embedding_service() -> EmbeddingService:
+    """The process-wide service every cache shares, so the model loads once."""
+    global _service
+    with _service_lock:
+        if _service is None:
+            if os.environ.get("EMBED_BACKEND", "local") == "openai":
+                backend = openai_backend(os.environ.get("EMBED_MODEL", "text-embedding-3-small"))
+            else:
+                backend = sentence_transformer_backend(os.environ.get("EMBED_MODEL", "all-MiniLM-L6-v2"))
+            _service = EmbeddingService(backend, quantized=os.environ.get("EMBED_INT8") == "1")
+        return _service
@@ -1,49 +1,133 @@
 import redis
 import time
-import json
 import numpy as np
 import ollama
-from sentence_transformers import SentenceTransformer
 
+from adaptive_threshold import AdaptiveThreshold, prompt_bucket
+from ann_index import FlatIndex, normalize
+from embedding_service import get_embedding_service
+
+# Each entry is its own hash (q, ans, emb as raw float32 bytes) and every insert
+# appends the entry id to a stream in the same MULTI. Lookups replay only the
+# stream tail past the last id they saw into a local index, so steady-state
+# searches cost one small round-trip instead of re-reading the whole cache.
 class LLMCache:
-    def __init__(self, host='localhost', port=6379, sim_threshold=0.85):
+    def __init__(self, host='localhost', port=6379, sim_threshold=0.85, index=None,
+                 prefix="semantic_cache", agree=0.9, embedder=None, shadow_rate=0.0):
         self.r = redis.Redis(host=host, port=port, decode_responses=False)
         self.r.ping()
-        self.encoder = SentenceTransformer('all-MiniLM-L6-v2')
+        # the process-wide local model, batched with every other cache's lookups
+        self.embedder = embedder if embedder is not None else get_embedding_service()
         self.threshold = sim_threshold
-        self.cache_key = "semantic_cache_entries"
+        # per-length-bucket cutoffs, starting at sim_threshold and calibrated from
+        # near-misses and, with shadow_rate > 0, a sample of hits re-asked live
+        self.thresholds = AdaptiveThreshold(default=sim_threshold, agree=agree,
+                                            shadow_rate=shadow_rate)
+        self.prefix = prefix
+        self.id_key = f"{prefix}:next_id"
+        self.log_key = f"{prefix}:log"
+        self.epoch_key = f"{prefix}:epoch"
+        # local mirror of the Redis entries; FlatIndex is exact, IVFFlatIndex approximate
+        self.index = index if index is not None else FlatIndex()
+        self._answers = {}
+        self._last_seen = None
+        self._epoch = None
+
+    def _entry_key(self, eid):
+        return f"{self.prefix}:entry:{eid}"
 
     def _embed(self, text):
-        return self.encoder.encode(text, convert_to_numpy=True).astype(np.float32)
-
-    def _cosine_sim(self, a, b):
-        return float(np.dot(a, b) / (np.linalg.norm(a) * np.linalg.norm(b)))
+        return self.embedder.embed(text)
+
+    def _reset_mirror(self):
+        for label in self._answers:
+            self.index.remove(label)
+        self._answers = {}
+        self._last_seen = None
+
+    def _sync(self):
+        pipe = self.r.pipeline(transaction=False)
+        pipe.get(self.epoch_key)
+        pipe.xrange(self.log_key, min=b"(" + self._last_seen if self._last_seen else "-")
+        epoch, events = pipe.execute()
+        if epoch != self._epoch:
+            # cache was cleared (or this is the first sync): rebuild from the full log
+            self._reset_mirror()
+            self._epoch = epoch
+            events = self.r.xrange(self.log_key)
+        if not events:
+            return
+        ids = [int(fields[b"id"]) for _, fields in events]
+        pipe = self.r.pipeline(transaction=False)
+        for eid in ids:
+            pipe.hmget(self._entry_key(eid), "ans", "emb")
+        for eid, (ans, emb) in zip(ids, pipe.execute()):
+            if ans is None:
+                continue
+            self.index.add(eid, np.frombuffer(emb, dtype=np.float32))
+            self._answers[eid] = ans.decode()
+        self._last_seen = events[-1][0]
 
     def search_cache(self, query):
-        emb = self._embed(query)
-        raw = self.r.get(self.cache_key)
-        if not raw:
+        emb = normalize(self._embed(query))
+        self._sync()
+        if not self._answers:
             return None, 0.0
 
-        entries = json.loads(raw)
-        best_sim, best_ans = 0.0, None
-        for entry in entries:
-            cached_emb = np.array(entry["emb"], dtype=np.float32)
-            sim = self._cosine_sim(emb, cached_emb)
-            if sim > best_sim:
-                best_sim = sim
-                best_ans = entry["ans"]
+        labels, sims = self.index.search(emb)
+        if not len(labels):
+            return None, 0.0
+        best_sim, best_ans = float(sims[0]), self._answers[int(labels[0])]
 
-        if best_sim >= self.threshold:
+        bucket = prompt_bucket("", query)
+        hit = best_sim >= self.thresholds.threshold(bucket)
+        self.thresholds.observe_lookup(bucket, hit)
+        if hit:
             return best_ans, best_sim
         return None, best_sim
 
+    def _label_near_miss(self, query, emb, ans):
+        # a near-miss answered live: label it by whether the neighbour's answer agrees
+        bucket = prompt_bucket("", query)
+        labels, sims = self.index.search(emb)
+        if not len(labels) or not self.thresholds.wants_label(bucket, float(sims[0])):
+            return
+        neighbour = self._answers.get(int(labels[0]))
+        if neighbour is None:
+            return
+        self.thresholds.label(bucket, float(sims[0]), neighbour, ans, self._embed)
+
+    def label_hit(self, query, sim, cached, live):
+        # a shadowed hit: a live answer that disagrees with the cached one is a false hit
+        self.thresholds.label(prompt_bucket("", query), sim, cached, live, self._embed)
+
     def add_to_cache(self, query, ans):
-        emb = self._embed(query).tolist()
-        raw = self.r.get(self.cache_key)
-        entries = json.loads(raw) if raw else []
-        entries.append({"q": query, "emb": emb, "ans": ans})
-        self.r.set(self.cache_key, json.dumps(entries))
+        emb = normalize(self._embed(query))
+        self._label_near_miss(query, emb, ans)
+        eid = self.r.incr(self.id_key)
+        pipe = self.r.pipeline(transaction=True)
+        pipe.hset(self._entry_key(eid), mapping={"q": query, "ans": ans, "emb": emb.tobytes()})
+        pipe.xadd(self.log_key, {"id": eid})
+        pipe.execute()
+
+    def clear(self):
+        keys = list(self.r.scan_iter(match=f"{self.prefix}:entry:*"))
+        pipe = self.r.pipeline(transaction=True)
+        if keys:
+            pipe.delete(*keys)
+        pipe.delete(self.log_key, self.id_key)
+        pipe.incr(self.epoch_key)
+        pipe.execute()
+        self._reset_mirror()
+
+
+def _ask(query):
+    res = ollama.chat(model='llama3.2', messages=[{"role": "user", "content": query}])
+    return res['message']['content']
+
+
+def _shadow_verify(query, sim, cached, cache):
+    cache.label_hit(query, sim, cached, _ask(query))
 
 
 def run_query(query, cache):
@@ -53,12 +137,14 @@ def run_query(query, cache):
     if ans:
         cached = True
         print(f"CACHE HIT! sim={sim:.3f}")
+        # a sample of hits is also answered live in the background to catch false hits
+        if cache.thresholds.wants_shadow():
+            cache.thresholds.shadow(_shadow_verify, query, sim, ans, cache)
     else:
         cached = False
         print(f"CACHE MISS! sim={sim:.3f}, calling ollama...")
         try:
-            res = ollama.chat(model='llama3.2', messages=[{"role": "user", "content": query}])
-            ans = res['message']['content']
+            ans = _ask(query)
         except Exception as e:
             ans = f"err: {e}"
             return ans, cached, time.time() - t0
@@ -69,7 +155,7 @@ def run_query(query, cache):
 
 if __name__ == "__main__":
     cache = LLMCache()
-    cache.r.delete("semantic_cache_entries")
+    cache.clear()
 
     tests = [
         "What is the capital of Japan?",
@@ -0,0 +1,76 @@
+"""SingleFlight must not let one cancelled caller cancel the others sharing its call."""
+import asyncio
+import os
+
+os.environ.setdefault("AGENT_CACHE_DB", "")
+
+from caching_agents import SingleFlight
+
+
+def test_cancelled_leader_still_serves_followers():
+    async def scenario():
+        sf = SingleFlight()
+        calls = 0
+
+        async def slow():
+            nonlocal calls
+            calls += 1
+            await asyncio.sleep(0.05)
+            return "answer"
+
+        leader = asyncio.create_task(sf.ado("k", slow))
+        await asyncio.sleep(0)
+        follower = asyncio.create_task(sf.ado("k", slow))
+        await asyncio.sleep(0)
+        leader.cancel()
+        result = await asyncio.wait_for(follower, timeout=1)
+        try:
+            await leader
+        except asyncio.CancelledError:
+            pass
+        else:
+            raise AssertionError("leader should have been cancelled")
+        return result, calls, sf.stats
+
+    (text, led), calls, stats = asyncio.run(scenario())
+    assert (text, led) == ("answer", False)
+    assert calls == 1
+    assert stats["in_flight"] == 0
+
+
+def test_cancelled_follower_leaves_others_waiting():
+    async def scenario():
+        sf = SingleFlight()
+
+        async def slow():
+            await asyncio.sleep(0.05)
+            return "answer"
+
+        leader = asyncio.create_task(sf.ado("k", slow))
+        await asyncio.sleep(0)
+        gone = asyncio.create_task(sf.ado("k", slow))
+        stays = asyncio.create_task(sf.ado("k", slow))
+        await asyncio.sleep(0)
+        gone.cancel()
+        results = await asyncio.wait_for(asyncio.gather(leader, stays), timeout=1)
+        return results, gone.cancelled(), sf.stats
+
+    (lead, follow), gone_cancelled, stats = asyncio.run(scenario())
+    assert lead == ("answer", True)
+    assert follow == ("answer", False)
+    assert gone_cancelled
+    assert stats["in_flight"] == 0
+
+
+def test_leader_error_reaches_followers():
+    async def scenario():
+        sf = SingleFlight()
+
+        async def boom():
+            await asyncio.sleep(0.01)
+            raise ValueError("upstream failed")
+
+        return await asyncio.gather(sf.ado("k", boom), sf.ado("k", boom), return_exceptions=True)
+
+    results = asyncio.run(scenario())
+    assert all(isinstance(r, ValueError) for r in results)